@@ -0,0 +1,566 @@
+# archive.py
+# Cold-message archival into compressed per-conversation segment files.
+#
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS are moved out of the messages
+# table, oldest first, in blocks of CHAT_ARCHIVE_BLOCK messages. Each block
+# is one zlib-compressed JSON array appended to the conversation's segment
+# file in CHAT_ARCHIVE_DIR; archive_blocks (models.ArchiveBlock) is the
+# offset index: file, offset, length, crc and the (created_at, id) range of
+# every block. The newest CHAT_ARCHIVE_KEEP messages of a conversation always
+# stay live, so the sidebar summary, the recent-messages buffer and unread
+# counts keep working off the live table.
+#
+# Because blocks are taken oldest first, a conversation's archive is always
+# a prefix of its history: everything archived sorts before everything
+# live. history.page_messages relies on that and simply continues into the
+# archive once a page runs past the oldest live message.
+#
+# Moving a block is one transaction: DELETE ... RETURNING picks the rows
+# and takes the write lock, the block is appended to the segment and
+# fsynced while the lock is held (so workers never append to a file at the
+# same time), then the index row is inserted and everything commits. A
+# crash before the commit leaves the messages live and some unreferenced
+# bytes at the end of the segment; `compact` drops those.
+#
+# Archived messages stay searchable: the same transaction indexes them in
+# archived_messages_fts (see search.py), which holds their text for search
+# only. They are no longer in /sync payloads or unread counts.
+#
+#   python archive.py run [days]   archive everything older than days
+#                                  (default CHAT_ARCHIVE_AFTER_DAYS)
+#   python archive.py compact      rewrite segments into full blocks, drop
+#                                  unreferenced bytes and files, VACUUM
+#
+# Run `compact` with the app stopped: it replaces segment files that
+# running workers may be reading.
+import os
+import sys
+import json
+import zlib
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, exists, or_, select, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+import database
+import models
+import search
+from shards import router
+from logs import get_logger, event
+
+log = get_logger("archive")
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "0"))  # 0 = job off
+ARCHIVE_KEEP = max(1, int(os.getenv("CHAT_ARCHIVE_KEEP", "200")))
+ARCHIVE_BLOCK = int(os.getenv("CHAT_ARCHIVE_BLOCK", "500"))
+ARCHIVE_INTERVAL = float(os.getenv("CHAT_ARCHIVE_INTERVAL_S", "3600"))
+ARCHIVE_DIR = os.getenv(
+    "CHAT_ARCHIVE_DIR", os.path.splitext(database.DATABASE_PATH)[0] + ".archive"
+)
+# decoded blocks kept for paging back and forth through old history
+_BLOCK_CACHE = 64
+
+# a block row: (id, sender_id, content, created_at, status)
+Row = Tuple[int, int, str, datetime, str]
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _path(segment: str) -> str:
+    return os.path.join(ARCHIVE_DIR, segment)
+
+
+def _encode(rows: List[Row]) -> bytes:
+    return zlib.compress(
+        json.dumps(
+            [[r[0], r[1], r[2], r[3].isoformat(), r[4]] for r in rows],
+            separators=(",", ":"),
+        ).encode()
+    )
+
+
+def _read_block_uncached(path: str, offset: int, length: int, crc: int) -> Tuple[Row, ...]:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length or zlib.crc32(data) != crc:
+        raise ArchiveError(f"corrupt archive block {path}@{offset}")
+    return tuple(
+        (r[0], r[1], r[2], datetime.fromisoformat(r[3]), r[4])
+        for r in json.loads(zlib.decompress(data))
+    )
+
+
+_read_block = lru_cache(maxsize=_BLOCK_CACHE)(_read_block_uncached)
+
+
+def _block_rows(block: models.ArchiveBlock, cached: bool = True) -> Tuple[Row, ...]:
+    read = _read_block if cached else _read_block_uncached
+    return read(_path(block.segment), block.offset, block.length, block.crc)
+
+
+def _fsync_dir(path: str):
+    if os.name == "nt":
+        return  # directories can't be opened for fsync on Windows
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# ---- reading ----
+
+def _messages(db: Session, convo_id: int, rows: List[Row]) -> List[models.Message]:
+    """Detached Message objects (with .sender) for archived rows."""
+    users = {
+        u.id: u
+        for u in db.query(models.User).filter(models.User.id.in_({r[1] for r in rows}))
+    } if rows else {}
+    out = []
+    for msg_id, sender_id, content, created_at, status in rows:
+        m = models.Message(
+            id=msg_id,
+            conversation_id=convo_id,
+            sender_id=sender_id,
+            content=content,
+            created_at=created_at,
+            status=status,
+        )
+        # as if loaded: no backref append, nothing for a flush to pick up
+        set_committed_value(m, "sender", users.get(sender_id))
+        out.append(m)
+    return out
+
+
+def high_key(db: Session, convo_id: int) -> Optional[Tuple[datetime, int]]:
+    """(created_at, id) of the newest archived message, or None."""
+    B = models.ArchiveBlock
+    row = (
+        db.query(B.last_created_at, B.last_message_id)
+        .filter(B.conversation_id == convo_id)
+        .order_by(B.last_created_at.desc(), B.last_message_id.desc())
+        .first()
+    )
+    return (row[0], row[1]) if row else None
+
+
+def read_before(
+    db: Session, convo_id: int, key: Optional[Tuple[datetime, int]], n: int
+) -> List[models.Message]:
+    """Up to n archived messages older than key (or the newest ones), newest first."""
+    B = models.ArchiveBlock
+    q = db.query(B).filter(B.conversation_id == convo_id)
+    if key is not None:
+        ts, msg_id = key
+        q = q.filter(or_(
+            B.first_created_at < ts,
+            and_(B.first_created_at == ts, B.first_message_id < msg_id),
+        ))
+    out: List[Row] = []
+    for block in q.order_by(B.last_created_at.desc(), B.last_message_id.desc()).yield_per(16):
+        for r in reversed(_block_rows(block)):
+            if key is None or (r[3], r[0]) < key:
+                out.append(r)
+                if len(out) >= n:
+                    return _messages(db, convo_id, out)
+    return _messages(db, convo_id, out)
+
+
+def read_after(
+    db: Session, convo_id: int, key: Tuple[datetime, int], n: int
+) -> List[models.Message]:
+    """Up to n archived messages newer than key, oldest first."""
+    B = models.ArchiveBlock
+    ts, msg_id = key
+    q = db.query(B).filter(
+        B.conversation_id == convo_id,
+        or_(B.last_created_at > ts, and_(B.last_created_at == ts, B.last_message_id > msg_id)),
+    )
+    out: List[Row] = []
+    for block in q.order_by(B.last_created_at, B.last_message_id).yield_per(16):
+        for r in _block_rows(block):
+            if (r[3], r[0]) > key:
+                out.append(r)
+                if len(out) >= n:
+                    return _messages(db, convo_id, out)
+    return _messages(db, convo_id, out)
+
+
+def iter_blocks(db: Session, convo_id: int) -> Iterator[Tuple[Row, ...]]:
+    """Every archived row of a conversation, oldest first, one block at a time."""
+    B = models.ArchiveBlock
+    blocks = (
+        db.query(B)
+        .filter(B.conversation_id == convo_id)
+        .order_by(B.last_created_at, B.last_message_id)
+        .all()
+    )
+    for block in blocks:
+        # exports read everything once; don't push paging blocks out of the cache
+        yield _block_rows(block, cached=False)
+
+
+# ---- archiving ----
+
+def _segment_for(db: Session, convo_id: int) -> str:
+    B = models.ArchiveBlock
+    row = (
+        db.query(B.segment)
+        .filter(B.conversation_id == convo_id)
+        .order_by(B.id.desc())
+        .first()
+    )
+    return row[0] if row else f"{convo_id}.0.seg"
+
+
+def _append(segment: str, data: bytes) -> int:
+    """Append data to a segment, durably; returns its offset."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = _path(segment)
+    new = not os.path.exists(path)
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if new:
+        _fsync_dir(ARCHIVE_DIR)
+    return offset
+
+
+def _block(convo_id: int, segment: str, offset: int, data: bytes, rows: List[Row]) -> models.ArchiveBlock:
+    return models.ArchiveBlock(
+        conversation_id=convo_id,
+        segment=segment,
+        offset=offset,
+        length=len(data),
+        crc=zlib.crc32(data),
+        message_count=len(rows),
+        first_created_at=rows[0][3],
+        first_message_id=rows[0][0],
+        last_created_at=rows[-1][3],
+        last_message_id=rows[-1][0],
+    )
+
+
+def archive_conversation(
+    db: Session,
+    convo_id: int,
+    cutoff: datetime,
+    keep: int = ARCHIVE_KEEP,
+    block_size: int = ARCHIVE_BLOCK,
+) -> int:
+    """Move convo_id's messages older than cutoff (but not its newest `keep`) to the archive.
+
+    Commits once per block; returns the number of messages moved.
+    """
+    M = models.Message
+    boundary = (
+        db.query(M.created_at, M.id)
+        .filter(M.conversation_id == convo_id)
+        .order_by(M.created_at.desc(), M.id.desc())
+        .offset(max(1, keep) - 1)
+        .limit(1)
+        .first()
+    )
+    db.rollback()
+    if boundary is None:
+        return 0
+    b_ts, b_id = boundary
+
+    oldest = (
+        select(M.id)
+        .where(
+            M.conversation_id == convo_id,
+            M.created_at < cutoff,
+            or_(M.created_at < b_ts, and_(M.created_at == b_ts, M.id < b_id)),
+        )
+        .order_by(M.created_at, M.id)
+        .limit(block_size)
+    )
+    stmt = (
+        delete(M)
+        .where(M.id.in_(oldest))
+        .returning(M.id, M.sender_id, M.content, M.created_at, M.status)
+    )
+
+    moved = 0
+    while True:
+        try:
+            rows = sorted(
+                (tuple(r) for r in db.execute(stmt, execution_options={"synchronize_session": False})),
+                key=lambda r: (r[3], r[0]),
+            )
+            if not rows:
+                db.rollback()
+                return moved
+            segment = _segment_for(db, convo_id)
+            data = _encode(rows)
+            offset = _append(segment, data)
+            db.add(_block(convo_id, segment, offset, data, rows))
+            search.index_archived(db, convo_id, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        moved += len(rows)
+
+
+def archive_database(
+    session_factory,
+    cutoff: datetime,
+    keep: int = ARCHIVE_KEEP,
+    block_size: int = ARCHIVE_BLOCK,
+) -> Dict[str, int]:
+    M = models.Message
+    C = models.Conversation
+    db = session_factory()
+    try:
+        convo_ids = [
+            c for (c,) in db.query(C.id).filter(
+                exists().where(M.conversation_id == C.id, M.created_at < cutoff)
+            )
+        ]
+        db.rollback()
+        moved = 0
+        for convo_id in convo_ids:
+            moved += archive_conversation(db, convo_id, cutoff, keep, block_size)
+        return {"conversations": len(convo_ids), "messages": moved}
+    finally:
+        db.close()
+
+
+def ensure_search_index(db: Session) -> int:
+    """Index archived messages that predate archived_messages_fts (once).
+
+    Returns the number of messages indexed.
+    """
+    if db.execute(text("SELECT 1 FROM archived_messages_fts LIMIT 1")).first():
+        return 0
+    return rebuild_search_index(db)
+
+
+def rebuild_search_index(db: Session) -> int:
+    """Re-index archived_messages_fts from the archive blocks, from scratch.
+
+    Returns the number of messages indexed.
+    """
+    B = models.ArchiveBlock
+    try:
+        db.execute(text("DELETE FROM archived_messages_fts"))
+        indexed = 0
+        for (convo_id,) in db.query(B.conversation_id).distinct().all():
+            for rows in iter_blocks(db, convo_id):
+                search.index_archived(db, convo_id, rows)
+                indexed += len(rows)
+        db.execute(text("INSERT INTO archived_messages_fts(archived_messages_fts) VALUES ('optimize')"))
+        db.commit()
+        return indexed
+    except Exception:
+        db.rollback()
+        raise
+
+
+# ---- background job ----
+
+class Archiver:
+    def __init__(
+        self,
+        after_days: float = ARCHIVE_AFTER_DAYS,
+        interval: float = ARCHIVE_INTERVAL,
+        keep: int = ARCHIVE_KEEP,
+        block_size: int = ARCHIVE_BLOCK,
+    ):
+        self.after_days = after_days
+        self.interval = interval
+        self.keep = keep
+        self.block_size = block_size
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.archived = 0
+        self.last_run_at: Optional[datetime] = None
+
+    async def start(self):
+        if self.after_days <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as exc:
+                event(log, "archive_failed", logging.ERROR, error=repr(exc))
+            await asyncio.sleep(self.interval)
+
+    def run_once(self) -> Dict[str, int]:
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        total = {"conversations": 0, "messages": 0}
+        for shard in router.shards:
+            result = archive_database(shard.SessionLocal, cutoff, self.keep, self.block_size)
+            for k in total:
+                total[k] += result[k]
+        self.runs += 1
+        self.archived += total["messages"]
+        self.last_run_at = datetime.utcnow()
+        event(log, "archived", **total)
+        return total
+
+    def stats(self):
+        return {
+            "enabled": self.after_days > 0,
+            "after_days": self.after_days,
+            "keep": self.keep,
+            "runs": self.runs,
+            "archived": self.archived,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "block_cache": _read_block.cache_info()._asdict(),
+        }
+
+
+archiver = Archiver()
+
+
+# ---- compaction ----
+
+def _generation(segment: str) -> int:
+    return int(segment.split(".")[1])
+
+
+def compact_conversation(db: Session, convo_id: int, block_size: int = ARCHIVE_BLOCK) -> bool:
+    """Rewrite a conversation's archive as full blocks in a fresh segment.
+
+    Returns False if it was already compact.
+    """
+    B = models.ArchiveBlock
+    blocks = (
+        db.query(B)
+        .filter(B.conversation_id == convo_id)
+        .order_by(B.last_created_at, B.last_message_id)
+        .all()
+    )
+    if not blocks:
+        return False
+    segments = {b.segment for b in blocks}
+    total = sum(b.message_count for b in blocks)
+    used = sum(b.length for b in blocks)
+    size = sum(os.path.getsize(_path(s)) for s in segments if os.path.exists(_path(s)))
+    if len(segments) == 1 and len(blocks) == -(-total // block_size) and size == used:
+        return False
+
+    segment = f"{convo_id}.{max(_generation(s) for s in segments) + 1}.seg"
+    new_blocks = []
+    with open(_path(segment), "wb") as f:
+        pending: List[Row] = []
+
+        def flush():
+            data = _encode(pending)
+            new_blocks.append(_block(convo_id, segment, f.tell(), data, pending))
+            f.write(data)
+            pending.clear()
+
+        for block in blocks:
+            for r in _block_rows(block, cached=False):
+                pending.append(r)
+                if len(pending) >= block_size:
+                    flush()
+        if pending:
+            flush()
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_dir(ARCHIVE_DIR)
+
+    # the index switches to the new segment atomically; the old files go after
+    for block in blocks:
+        db.delete(block)
+    db.flush()
+    db.add_all(new_blocks)
+    db.commit()
+    for s in segments:
+        if os.path.exists(_path(s)):
+            os.remove(_path(s))
+    return True
+
+
+def compact():
+    compacted = 0
+    referenced = set()
+    for shard in router.shards:
+        db = shard.SessionLocal()
+        try:
+            B = models.ArchiveBlock
+            for (convo_id,) in db.query(B.conversation_id).distinct().all():
+                compacted += compact_conversation(db, convo_id)
+            referenced.update(s for (s,) in db.query(B.segment).distinct())
+        finally:
+            db.close()
+
+    # segments no index row points at (left by crashes or earlier compactions)
+    removed = 0
+    if os.path.isdir(ARCHIVE_DIR):
+        for name in os.listdir(ARCHIVE_DIR):
+            if name.endswith(".seg") and name not in referenced:
+                os.remove(_path(name))
+                removed += 1
+
+    for shard in router.shards:
+        with shard.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+            conn.exec_driver_sql(
+                "INSERT INTO archived_messages_fts(archived_messages_fts) VALUES ('optimize')"
+            )
+            conn.exec_driver_sql("VACUUM")
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"compacted {compacted} conversations, removed {removed} stale segments, vacuumed")
+
+
+def _setup_schema():
+    from database import Base
+    from shards import shard_tables
+
+    router.ensure_directory()
+    for shard in router.shards:
+        Base.metadata.create_all(bind=shard.engine, tables=shard_tables())
+        search.ensure_fts(shard.engine)
+        _db = shard.SessionLocal()
+        try:
+            ensure_search_index(_db)
+        finally:
+            _db.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["run"] and len(args) <= 2:
+        _setup_schema()
+        days = float(args[1]) if len(args) == 2 else ARCHIVE_AFTER_DAYS
+        if days <= 0:
+            print("usage: python archive.py run DAYS (or set CHAT_ARCHIVE_AFTER_DAYS)")
+            sys.exit(2)
+        result = Archiver(after_days=days).run_once()
+        print(f"archived {result['messages']} messages from {result['conversations']} conversations")
+    elif args == ["compact"]:
+        _setup_schema()
+        compact()
+    else:
+        print("usage: python archive.py run [DAYS] | compact")
+        sys.exit(2)
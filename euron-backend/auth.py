@@ -1,4 +1,9 @@
 # auth.py
+import time
+import heapq
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import jwt, JWTError
@@ -8,16 +13,159 @@ SECRET_KEY = "cVsds%42hjghtesbksr"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # adjust
 
+TOKEN_CACHE_SIZE = 10_000
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    # iat as a float, so revoke_user can cut off within the same second
+    to_encode.update({"exp": expire, "iat": time.time()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+
+class TokenCache:
+    """Bounded LRU of already-verified token claims.
+
+    The client sends the same token on every call, so most verifications
+    are repeats. Entries are keyed by the token's SHA-256 (the raw token is
+    never kept) and expire at the token's own `exp`. Revoked tokens are
+    remembered until they would have expired anyway; expired revocations
+    are pruned on every revoke (oldest `exp` first, via a heap), so the set
+    never holds more than the tokens revoked within one token lifetime.
+    revoke_user records a per-user cutoff instead: tokens issued (`iat`)
+    before it are rejected, cached or not.
+
+    Like the cache itself, revocations live in this worker's memory only.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._revoked = {}
+        self._revoked_heap = []  # (exp, key), for pruning
+        self._revoked_before = {}  # user_id -> cutoff timestamp
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, exp = entry
+            if exp is not None and exp <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(payload)
+
+    def put(self, key: str, payload: dict):
+        exp = payload.get("exp")
+        with self._lock:
+            self._entries[key] = (dict(payload), exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def is_revoked(self, key: str) -> bool:
+        with self._lock:
+            exp = self._revoked.get(key)
+            if exp is None:
+                return False
+            if exp <= time.time():
+                del self._revoked[key]
+                return False
+            return True
+
+    def revoke(self, token: str):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            exp = entry[1] if entry else None
+        if exp is None:
+            try:
+                exp = jwt.get_unverified_claims(token).get("exp")
+            except JWTError:
+                return
+        exp = exp or time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        with self._lock:
+            self._revoked[key] = exp
+            heapq.heappush(self._revoked_heap, (exp, key))
+            self._prune_revoked(time.time())
+
+    def _prune_revoked(self, now: float):
+        # caller holds the lock
+        heap = self._revoked_heap
+        while heap and heap[0][0] <= now:
+            exp, key = heapq.heappop(heap)
+            if self._revoked.get(key) == exp:
+                del self._revoked[key]
+
+    def revoke_user(self, user_id: int):
+        """Reject every token of a user issued until now (logout everywhere)."""
+        now = time.time()
+        with self._lock:
+            self._revoked_before[user_id] = now
+            for key in [k for k, (p, _) in self._entries.items() if p.get("user_id") == user_id]:
+                del self._entries[key]
+            # older cutoffs only cover tokens that have expired by now
+            oldest = now - ACCESS_TOKEN_EXPIRE_MINUTES * 60
+            for uid in [u for u, t in self._revoked_before.items() if t <= oldest]:
+                del self._revoked_before[uid]
+
+    def issued_before_cutoff(self, payload: dict) -> bool:
+        cutoff = self._revoked_before.get(payload.get("user_id"))
+        # tokens minted before iat was added have none: treat them as oldest
+        return cutoff is not None and payload.get("iat", 0) <= cutoff
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "revoked": len(self._revoked),
+                "revoked_users": len(self._revoked_before),
+            }
+
+
+token_cache = TokenCache()
+
+
 def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload  # contains whatever you encoded (e.g. user_id)
-    except JWTError:
+    key = TokenCache.digest(token)
+    if token_cache.is_revoked(key):
         return None
+
+    payload = token_cache.get(key)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+        token_cache.put(key, payload)
+    if token_cache.issued_before_cutoff(payload):
+        return None
+    return payload  # contains whatever you encoded (e.g. user_id)
+
+
+def revoke_token(token: str):
+    token_cache.revoke(token)
+
+
+def revoke_user(user_id: int):
+    token_cache.revoke_user(user_id)
@@ -0,0 +1,155 @@
+# bench_fanout.py
+# Broadcast delivery latency vs group size, inline vs sharded fan-out.
+#
+#   python bench_fanout.py [--sizes 10,100,1000,5000,10000] [--burst 10] [--rounds 5]
+#
+# Runs a ConnectionManager in-process with N sockets subscribed to one
+# conversation. The sockets are in-memory sinks that timestamp each frame, so
+# the numbers are the server side only: broker -> fan-out -> socket queue ->
+# writer task. Each round publishes --burst messages back to back (a busy
+# group), then waits until every socket has received them.
+#
+# Modes:
+#   inline     everything delivered in one loop (CHAT_FANOUT_LARGE above N)
+#   sharded    shards + yielding, no coalescing window
+#   coalesced  shards + CHAT_FANOUT_COALESCE_MS window, sockets opened with ?batch=1
+#
+# Reported per mode and size: p50/p99 delivery latency (publish -> frame
+# handed to the socket) and the worst event-loop stall seen by a 1 ms
+# ticker, i.e. how long everything else on the worker was blocked.
+import argparse
+import asyncio
+import gc
+import json
+import time
+
+from broker import Broker
+from connections import ClientConnection, ConnectionManager
+from fanout import Fanout, FANOUT_SHARD_SIZE, FANOUT_CONCURRENCY
+
+CONVO_ID = 1
+
+
+class Sink:
+    """Delivery latency of every event on every socket."""
+
+    def __init__(self):
+        self.latencies = []  # floats only, so the GC has nothing to walk
+        self.frames = 0
+        self.delivered = 0
+        # frames are shared between sockets, so decode each distinct one once
+        self._decoded = {}
+
+    def events_in(self, frame):
+        cached = self._decoded.get(id(frame))
+        if cached is not None and cached[0] is frame:
+            return cached[1]
+        event = json.loads(frame)
+        events = event["events"] if event["type"] == "batch" else [event]
+        # keep the frame alive so its id isn't reused by a later one
+        self._decoded[id(frame)] = (frame, events)
+        return events
+
+    def record(self, frame):
+        received = time.perf_counter()
+        events = self.events_in(frame)
+        for event in events:
+            self.latencies.append(received - event["sent_at"])
+        self.frames += 1
+        self.delivered += len(events)
+
+
+class SinkSocket:
+    """Stands in for a WebSocket: records when each frame was sent."""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    async def send_text(self, data):
+        self.sink.record(data)
+
+    async def send_bytes(self, data):
+        self.sink.record(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run(size, mode, burst, rounds, coalesce_ms):
+    manager = ConnectionManager(Broker(), sweep_interval=0)
+    manager.fanout = Fanout(
+        lambda convo_id: list(manager.active_connections.get(convo_id, ())),
+        large=size + 1 if mode == "inline" else 0,
+        shard_size=FANOUT_SHARD_SIZE,
+        concurrency=FANOUT_CONCURRENCY,
+        coalesce=coalesce_ms / 1000 if mode == "coalesced" else 0,
+    )
+    await manager.start()
+
+    sink = Sink()
+    conns = []
+    for user_id in range(size):
+        conn = ClientConnection(
+            SinkSocket(sink), user_id=user_id, convo_id=CONVO_ID, batch=mode == "coalesced"
+        )
+        manager._add(conn, CONVO_ID)
+        conn.start(manager._remove)
+        conns.append(conn)
+    # let the writer tasks start (and a collection run) before measuring
+    await asyncio.sleep(0.05)
+    gc.collect()
+
+    stalls = []
+
+    async def ticker():
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - t - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    expected = 0
+    for _ in range(rounds):
+        for i in range(burst):
+            payload = {"type": "message_created", "message": {"id": i, "content": "x" * 80},
+                       "sent_at": time.perf_counter()}
+            await manager.broadcast_to_conversation(CONVO_ID, payload)
+        expected += burst * size
+        while sink.delivered < expected:
+            await asyncio.sleep(0.001)
+    tick.cancel()
+
+    for conn in conns:
+        conn.close()
+    await manager.stop()
+    return {
+        "p50_ms": pct(sink.latencies, 0.50) * 1000,
+        "p99_ms": pct(sink.latencies, 0.99) * 1000,
+        "max_stall_ms": max(stalls, default=0.0) * 1000,
+        "frames": sink.frames,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000,5000,10000")
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--coalesce-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'sockets':>8} {'p50 ms':>9} {'p99 ms':>9} {'stall ms':>9} {'frames':>9}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for mode in ("inline", "sharded", "coalesced"):
+            r = asyncio.run(run(size, mode, args.burst, args.rounds, args.coalesce_ms))
+            print(f"{mode:<10} {size:>8} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}"
+                  f" {r['max_stall_ms']:>9.2f} {r['frames']:>9}")
+
+
+if __name__ == "__main__":
+    main()
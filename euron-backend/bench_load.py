@@ -0,0 +1,329 @@
+# bench_load.py
+# End-to-end load and latency benchmark for the chat backend.
+#
+#   python bench_load.py [--users 200] [--conversations 50] [--messages 20000]
+#                        [--clients 20] [--duration 20] [--workers 1]
+#                        [--out results.json] [--env CHAT_GROUP_COMMIT=1 ...]
+#
+# 1. Seeds a fresh temp database (users, group conversations, messages).
+#    Summaries, search indexes and the change log are built by the app's
+#    own startup, as they would be for an existing users.db.
+# 2. Starts the real app under uvicorn on that database (CHAT_DATABASE_PATH).
+# 3. Logs in --clients simulated users (all at once; timed separately since
+#    it is bcrypt-bound), then runs them for --duration seconds. Each holds a
+#    multiplexed /ws socket and loops over: list conversations, open a
+#    conversation (newest page, then one page back), post a message.
+# 4. Prints and saves per-route throughput and p50/p95/p99 latency, plus
+#    broadcast delivery latency (POST sent -> event received on another
+#    member's socket).
+#
+# Needs httpx and websockets besides requirements.txt.
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import httpx
+import websockets
+from sqlalchemy import text
+
+from database import Base, build_engines
+from passwords import pwd_context
+import models  # noqa: F401  (registers the tables on Base)
+
+PASSWORD = "bench-password"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# --------------------------------------------------
+# Seeding
+# --------------------------------------------------
+
+def seed(path, users, conversations, messages, seed_value=1):
+    rnd = random.Random(seed_value)
+    engine = build_engines(path, "wal")[0]
+    Base.metadata.create_all(bind=engine)
+    hashed = pwd_context.hash(PASSWORD)  # one bcrypt for everyone
+
+    members = {}
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO users (id, name, email, password) VALUES (:id, :name, :email, :pw)"),
+            [
+                {"id": i, "name": f"bench user {i}", "email": f"bench{i}@example.com", "pw": hashed}
+                for i in range(1, users + 1)
+            ],
+        )
+        for cid in range(1, conversations + 1):
+            size = rnd.randint(2, min(users, 12))
+            members[cid] = rnd.sample(range(1, users + 1), size)
+            conn.execute(
+                text("INSERT INTO conversations (id, is_group, title, created_by) VALUES (:id, 1, :t, :by)"),
+                {"id": cid, "t": f"bench group {cid}", "by": members[cid][0]},
+            )
+            conn.execute(
+                text(
+                    "INSERT INTO conversation_participants (conversation_id, user_id, role)"
+                    " VALUES (:c, :u, :r)"
+                ),
+                [
+                    {"c": cid, "u": uid, "r": "admin" if i == 0 else "member"}
+                    for i, uid in enumerate(members[cid])
+                ],
+            )
+
+        start = datetime.utcnow() - timedelta(days=30)
+        step = timedelta(days=30) / max(messages, 1)
+        batch = []
+        for i in range(messages):
+            cid = rnd.randint(1, conversations)
+            batch.append({
+                "c": cid,
+                "s": rnd.choice(members[cid]),
+                "t": f"seed message {i} " + "lorem ipsum " * rnd.randint(1, 8),
+                "ts": start + step * i,
+            })
+            if len(batch) == 5000 or i == messages - 1:
+                conn.execute(
+                    text(
+                        "INSERT INTO messages (conversation_id, sender_id, content, created_at, status)"
+                        " VALUES (:c, :s, :t, :ts, 'sent')"
+                    ),
+                    batch,
+                )
+                batch = []
+    engine.dispose()
+    return members
+
+
+# --------------------------------------------------
+# Server
+# --------------------------------------------------
+
+def start_server(path, port, workers, extra_env):
+    env = dict(os.environ, CHAT_DATABASE_PATH=path, **extra_env)
+    if workers > 1 and "CHAT_BROKER" not in extra_env:
+        env["CHAT_BROKER"] = "sqlite"
+        env["CHAT_BROKER_PATH"] = os.path.join(os.path.dirname(path), "broker.db")
+
+    # run startup (schema, backfills) once before forking workers
+    subprocess.run([sys.executable, "-c", "import main"], cwd=HERE, env=env, check=True)
+
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+        ],
+        cwd=HERE,
+        env=env,
+    )
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            httpx.get(base + "/docs", timeout=1)
+            return proc, base
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("server did not start")
+
+
+# --------------------------------------------------
+# Clients
+# --------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.broadcast = []
+
+    async def timed(self, route, coro):
+        start = time.perf_counter()
+        try:
+            response = await coro
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[route] += 1
+        return response
+
+
+async def log_in(base, user_id, rec):
+    async with httpx.AsyncClient(base_url=base, timeout=60) as http:
+        r = await rec.timed(
+            "POST /login",
+            http.post("/login", json={"email": f"bench{user_id}@example.com", "password": PASSWORD}),
+        )
+    if r is None or r.status_code != 200:
+        return None
+    return r.json()["access_token"]
+
+
+async def run_client(base, user_id, token, rec, deadline, rnd):
+    async with httpx.AsyncClient(base_url=base, timeout=30) as http:
+        auth = {"Authorization": f"Bearer {token}"}
+
+        ws_url = base.replace("http", "ws", 1) + f"/ws?token={token}"
+        async with websockets.connect(ws_url, max_size=None) as ws:
+            listener = asyncio.create_task(listen(ws, user_id, rec))
+            try:
+                convo_ids = []
+                while time.monotonic() < deadline:
+                    r = await rec.timed("GET /conversations", http.get("/conversations", headers=auth))
+                    if r is not None and r.status_code == 200:
+                        convo_ids = [c["conversation_id"] for c in r.json()]
+                    if not convo_ids:
+                        await asyncio.sleep(0.1)
+                        continue
+
+                    cid = rnd.choice(convo_ids)
+                    r = await rec.timed(
+                        "GET /conversations/{id}/messages",
+                        http.get(f"/conversations/{cid}/messages", headers=auth),
+                    )
+                    cursor = r.headers.get("x-next-cursor") if r is not None else None
+                    if cursor:
+                        await rec.timed(
+                            "GET /conversations/{id}/messages?before",
+                            http.get(
+                                f"/conversations/{cid}/messages",
+                                params={"before": cursor},
+                                headers=auth,
+                            ),
+                        )
+
+                    content = f"bench|{user_id}|{time.time()}"
+                    await rec.timed(
+                        "POST /conversations/{id}/messages",
+                        http.post(
+                            f"/conversations/{cid}/messages",
+                            json={"content": content},
+                            headers=auth,
+                        ),
+                    )
+            finally:
+                listener.cancel()
+
+
+async def listen(ws, user_id, rec):
+    async for frame in ws:
+        received = time.time()
+        event = json.loads(frame)
+        if event.get("type") != "message_created":
+            continue
+        parts = event["message"]["content"].split("|")
+        if len(parts) == 3 and parts[0] == "bench" and parts[1] != str(user_id):
+            rec.broadcast.append(received - float(parts[2]))
+
+
+# --------------------------------------------------
+# Report
+# --------------------------------------------------
+
+def summarize(samples, duration):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return {
+        "count": len(samples),
+        "per_second": len(samples) / duration,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. CHAT_GROUP_COMMIT=1")
+    args = parser.parse_args()
+    extra_env = dict(e.split("=", 1) for e in args.env)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        t = time.perf_counter()
+        seed(path, args.users, args.conversations, args.messages, args.seed)
+        print(f"seeded {args.users} users, {args.conversations} conversations, "
+              f"{args.messages} messages in {time.perf_counter() - t:.1f}s")
+
+        proc, base = start_server(path, args.port, args.workers, extra_env)
+        try:
+            rec = Recorder()
+            rnd = random.Random(args.seed)
+            client_users = rnd.sample(range(1, args.users + 1), min(args.clients, args.users))
+
+            async def drive():
+                # logins (bcrypt) first, timed on their own, so they don't
+                # eat into the measured window
+                started = time.perf_counter()
+                tokens = await asyncio.gather(*(log_in(base, uid, rec) for uid in client_users))
+                login_elapsed = time.perf_counter() - started
+
+                started = time.perf_counter()
+                deadline = time.monotonic() + args.duration
+                await asyncio.gather(*(
+                    run_client(base, uid, token, rec, deadline, random.Random(args.seed + uid))
+                    for uid, token in zip(client_users, tokens)
+                    if token
+                ))
+                return login_elapsed, time.perf_counter() - started
+
+            login_elapsed, elapsed = asyncio.run(drive())
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    results = {
+        "config": {**vars(args), "env": extra_env, "elapsed_s": elapsed},
+        "routes": {
+            route: {
+                **summarize(samples, login_elapsed if route == "POST /login" else elapsed),
+                "errors": rec.errors.get(route, 0),
+            }
+            for route, samples in sorted(rec.latencies.items())
+        },
+        "broadcast_delivery": summarize(rec.broadcast, elapsed),
+    }
+
+    print(f"\n{'route':<42} {'count':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for route, r in results["routes"].items():
+        print(f"{route:<42} {r['count']:>7} {r['per_second']:>8.1f} {r['p50_ms']:>8.1f}"
+              f" {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errors']:>5}")
+    b = results["broadcast_delivery"]
+    if b["count"]:
+        print(f"{'broadcast delivery':<42} {b['count']:>7} {b['per_second']:>8.1f} {b['p50_ms']:>8.1f}"
+              f" {b['p95_ms']:>8.1f} {b['p99_ms']:>8.1f}")
+
+    out = args.out or f"bench-results-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# bench_login.py
+# Login storm against the bcrypt pool (passwords.py).
+#
+#   python bench_login.py [--logins 200] [--max-pending 16] [--workers 2]
+#
+# Seeds a temp database, starts the app with CHAT_PASSWORD_MAX_PENDING set
+# to --max-pending, fires --logins concurrent POST /login and, while they
+# run, polls GET /me to see how a cheap endpoint fares under the storm.
+# Prints the status code counts, /me latency and the pool's gauges from
+# /metrics. Exits non-zero if a storm larger than --max-pending got no 503s
+# back (the limit isn't enforced) or if any login failed with something
+# other than 200/503.
+#
+# Needs httpx besides requirements.txt.
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from bench_load import PASSWORD, seed, start_server, summarize
+
+
+async def storm(base, logins, users):
+    statuses = Counter()
+    me_latencies = []
+    done = asyncio.Event()
+
+    async with httpx.AsyncClient(base_url=base, timeout=120) as http:
+        r = await http.post("/login", json={"email": "bench1@example.com", "password": PASSWORD})
+        r.raise_for_status()
+        auth = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+        async def one(i):
+            r = await http.post(
+                "/login",
+                json={"email": f"bench{i % users + 1}@example.com", "password": PASSWORD},
+            )
+            statuses[r.status_code] += 1
+
+        async def poll_me():
+            while not done.is_set():
+                start = time.perf_counter()
+                await http.get("/me", headers=auth)
+                me_latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.02)
+
+        poller = asyncio.create_task(poll_me())
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(logins)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await poller
+
+        pool = pool_stats((await http.get("/metrics")).text)
+    return statuses, me_latencies, elapsed, pool
+
+
+def pool_stats(exposition: str) -> dict:
+    # the chat_password_pool_* gauges from /metrics, without the prefix
+    prefix = "chat_password_pool_"
+    return {
+        name[len(prefix):]: float(value)
+        for name, value in (
+            line.split(" ", 1) for line in exposition.splitlines() if line.startswith(prefix)
+        )
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--max-pending", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="bcrypt worker processes")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_login_")
+    path = os.path.join(tmp, "bench.db")
+    seed(path, args.users, 1, 0)
+    proc, base = start_server(path, args.port, 1, {
+        "CHAT_PASSWORD_MAX_PENDING": str(args.max_pending),
+        "CHAT_PASSWORD_WORKERS": str(args.workers),
+    })
+    try:
+        statuses, me_latencies, elapsed, pool = asyncio.run(storm(base, args.logins, args.users))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print(f"{args.logins} logins in {elapsed:.1f}s, max_pending={args.max_pending}")
+    for code, count in sorted(statuses.items()):
+        print(f"  {code}: {count}")
+    me = summarize(me_latencies, elapsed)
+    print(f"GET /me during the storm: n={me['count']} p50={me['p50_ms']:.1f}ms p99={me['p99_ms']:.1f}ms")
+    print(f"pool: {pool}")
+
+    ok = set(statuses) <= {200, 503}
+    if args.logins > args.max_pending and not statuses[503]:
+        print("FAIL: no 503s although the storm exceeded max_pending")
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# bench_storage.py
+# Concurrent read/write throughput for each storage profile in database.py.
+#
+#   python bench_storage.py [--seconds 5] [--readers 4] [--writers 2]
+#
+# Every profile gets a fresh temp database seeded with the same messages.
+# Reader processes page through history like GET /conversations/{id}/messages;
+# writer processes insert messages one commit at a time like post_message.
+# Processes rather than threads, so the numbers show SQLite locking (as with
+# several uvicorn workers) and not GIL hand-offs inside the benchmark.
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import Base, STORAGE_PROFILES, build_engines
+import models  # noqa: F401  (registers the tables on Base)
+
+SEED_MESSAGES = 50_000
+CONVERSATIONS = 20
+PAGE = 50
+
+
+def seed(engine):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, name, email) VALUES (1, 'bench', 'bench@x')"))
+        for cid in range(1, CONVERSATIONS + 1):
+            conn.execute(
+                text("INSERT INTO conversations (id, is_group, created_by) VALUES (:id, 1, 1)"),
+                {"id": cid},
+            )
+        now = datetime.utcnow()
+        conn.execute(
+            text(
+                "INSERT INTO messages (conversation_id, sender_id, content, created_at, status)"
+                " VALUES (:c, 1, :t, :ts, 'sent')"
+            ),
+            [
+                {"c": i % CONVERSATIONS + 1, "t": f"seed message {i}", "ts": now}
+                for i in range(SEED_MESSAGES)
+            ],
+        )
+
+
+def reader(path, profile, stop, counts, idx):
+    engine = build_engines(path, profile)[1]
+    n = 0
+    while not stop.is_set():
+        with engine.connect() as conn:
+            conn.execute(
+                text(
+                    "SELECT m.id, m.content, u.name FROM messages m"
+                    " JOIN users u ON u.id = m.sender_id"
+                    " WHERE m.conversation_id = :c"
+                    " ORDER BY m.created_at DESC, m.id DESC LIMIT :n"
+                ),
+                {"c": n % CONVERSATIONS + 1, "n": PAGE},
+            ).fetchall()
+        n += 1
+    counts[idx] = n
+
+
+def writer(path, profile, stop, counts, idx):
+    engine = build_engines(path, profile)[0]
+    n = 0
+    while not stop.is_set():
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO messages (conversation_id, sender_id, content, created_at, status)"
+                    " VALUES (:c, 1, :t, :ts, 'sent')"
+                ),
+                {"c": n % CONVERSATIONS + 1, "t": f"bench {n}", "ts": datetime.utcnow()},
+            )
+        n += 1
+    counts[idx] = n
+
+
+def run_profile(profile, seconds, readers, writers):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        write_engine, read_engine = build_engines(path, profile)
+        seed(write_engine)
+
+        write_engine.dispose()
+        read_engine.dispose()
+
+        stop = mp.Event()
+        read_counts = mp.Array("q", readers)
+        write_counts = mp.Array("q", writers)
+        procs = [
+            mp.Process(target=reader, args=(path, profile, stop, read_counts, i))
+            for i in range(readers)
+        ] + [
+            mp.Process(target=writer, args=(path, profile, stop, write_counts, i))
+            for i in range(writers)
+        ]
+        for p in procs:
+            p.start()
+        time.sleep(seconds)
+        stop.set()
+        for p in procs:
+            p.join()
+
+        return sum(read_counts) / seconds, sum(write_counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"{args.readers} reader / {args.writers} writer processes, {args.seconds:g}s per profile")
+    print(f"{'profile':<10} {'reads/s':>10} {'writes/s':>10}")
+    for profile in STORAGE_PROFILES:
+        reads, writes = run_profile(profile, args.seconds, args.readers, args.writers)
+        print(f"{profile:<10} {reads:>10.0f} {writes:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
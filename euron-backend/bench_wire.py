@@ -0,0 +1,118 @@
+# bench_wire.py
+# Encode time and size of JSON vs msgpack for what the server sends.
+#
+#   python bench_wire.py [--rounds 2000]
+#
+# Payloads:
+#   broadcast   one message_created WebSocket event
+#   history     a 200-message GET /conversations/{id}/messages page
+#   sync        a /sync page: 500 messages plus 20 sidebar items
+#
+# "rest" rows follow the REST path: Pydantic models serialized by the
+# response field (dump_json straight to bytes for JSON; Python objects then
+# msgpack.packb for msgpack). "ws" rows follow the broadcast path
+# (wire.encode on an already plain dict).
+import argparse
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import msgpack
+from pydantic import TypeAdapter
+
+import wire
+from schemas import MessageOut, SyncOut, ConversationListItem
+
+
+def make_messages(n: int) -> List[MessageOut]:
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    return [
+        MessageOut(
+            id=1000 + i,
+            conversation_id=7,
+            sender_id=1 + i % 5,
+            sender_name=f"user {1 + i % 5}",
+            content=f"message number {i}: " + "lorem ipsum dolor sit amet " * (1 + i % 4),
+            created_at=start + timedelta(seconds=i),
+            status="sent",
+        )
+        for i in range(n)
+    ]
+
+
+def make_sync() -> SyncOut:
+    return SyncOut(
+        cursor="123456",
+        has_more=True,
+        conversations=[
+            ConversationListItem(
+                conversation_id=i,
+                is_group=i % 3 == 0,
+                title=f"group {i}" if i % 3 == 0 else None,
+                display_name=f"chat {i}",
+                last_message="see you tomorrow",
+                last_message_at=datetime(2024, 1, 1, 12, 0, i),
+                last_read_message_id=1000 + i,
+                unread_count=i,
+            )
+            for i in range(20)
+        ],
+        messages=make_messages(500),
+        members=[],
+    )
+
+
+def timed(fn, rounds: int):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        out = fn()
+    return (time.perf_counter() - start) / rounds * 1e6, len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    event = {
+        "type": "message_created",
+        "message": make_messages(1)[0].model_dump(mode="json"),
+    }
+    history_adapter = TypeAdapter(List[MessageOut])
+    history = make_messages(200)
+    sync_adapter = TypeAdapter(SyncOut)
+    sync = make_sync()
+
+    cases = [
+        ("broadcast", "ws", "json", lambda: wire.encode(event, wire.JSON).encode()),
+        ("broadcast", "ws", "msgpack", lambda: wire.encode(event, wire.MSGPACK)),
+        ("history", "rest", "json", lambda: history_adapter.dump_json(history)),
+        ("history", "rest", "msgpack",
+         lambda: msgpack.packb(history_adapter.dump_python(history, mode="json"))),
+        ("sync", "rest", "json", lambda: sync_adapter.dump_json(sync)),
+        ("sync", "rest", "msgpack",
+         lambda: msgpack.packb(sync_adapter.dump_python(sync, mode="json"))),
+    ]
+
+    print(f"{'payload':<10} {'path':<5} {'format':<8} {'encode us':>10} {'bytes':>8}")
+    for name, path, fmt, fn in cases:
+        rounds = args.rounds if name == "broadcast" else max(1, args.rounds // 20)
+        us, size = timed(fn, rounds)
+        print(f"{name:<10} {path:<5} {fmt:<8} {us:>10.1f} {size:>8}")
+
+    # decode cost on the client side, for completeness
+    print()
+    print(f"{'payload':<10} {'format':<8} {'decode us':>10}")
+    blobs = [
+        ("history", "json", history_adapter.dump_json(history)),
+        ("history", "msgpack", msgpack.packb(history_adapter.dump_python(history, mode="json"))),
+    ]
+    for name, fmt, blob in blobs:
+        us, _ = timed(lambda: [wire.decode(blob if fmt == "msgpack" else blob.decode())],
+                      max(1, args.rounds // 20))
+        print(f"{name:<10} {fmt:<8} {us:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
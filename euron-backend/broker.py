@@ -0,0 +1,192 @@
+# broker.py
+# Pub/sub backends that let ConnectionManager fan out across uvicorn workers.
+#
+# Every worker holds its own sockets. broadcast_to_conversation publishes
+# through the broker; the broker hands the event back to each worker that
+# has subscribed to that conversation (including the publishing worker).
+# Negative channel ids carry per-user events (connections.user_channel).
+#
+#   CHAT_BROKER=memory   single process, no relay (default)
+#   CHAT_BROKER=sqlite   relay through a shared SQLite file, CHAT_BROKER_PATH
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Optional, Set
+
+from logs import get_logger, event
+
+log = get_logger("broker")
+
+Handler = Callable[[int, dict], Awaitable[None]]
+
+
+class Broker:
+    """In-process broker; also the interface other backends implement.
+
+    publish() always delivers to the local handler first, so a worker never
+    waits on the relay to reach its own sockets.
+    """
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self.subscriptions: Set[int] = set()
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+
+    def subscribe(self, convo_id: int):
+        self.subscriptions.add(convo_id)
+
+    def unsubscribe(self, convo_id: int):
+        self.subscriptions.discard(convo_id)
+
+    async def publish(self, convo_id: int, payload: dict):
+        if self._handler and convo_id in self.subscriptions:
+            await self._handler(convo_id, payload)
+
+
+class SqliteBroker(Broker):
+    """Relays events between workers through a shared SQLite table.
+
+    Publishers append rows; each worker polls for rows newer than the last
+    one it saw, restricted to the conversations it holds sockets for, and
+    skips rows it published itself. Old rows are pruned after `retention`
+    seconds. Needs no outside service, so several workers on one machine
+    can be tested against the same file.
+    """
+
+    # IN (...) lists longer than this are filtered in Python instead
+    MAX_IN_FILTER = 500
+
+    def __init__(self, path: str, poll_interval: float = 0.02, retention: float = 30.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # ---- sqlite helpers (run in a thread) ----
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " convo_id INTEGER NOT NULL,"
+            " origin TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_events_created ON events (created_at)")
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()
+        return conn, row[0]
+
+    def _insert(self, convo_id: int, text: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO events (convo_id, origin, payload, created_at) VALUES (?, ?, ?, ?)",
+                (convo_id, self.origin, text, time.time()),
+            )
+
+    def _fetch(self, subscribed):
+        with self._lock:
+            # read the high-water mark first so a row inserted mid-poll is
+            # picked up next time instead of being skipped
+            top = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            if not subscribed or top <= self._last_id:
+                return [], top
+
+            sql = (
+                "SELECT id, convo_id, payload FROM events"
+                " WHERE id > ? AND id <= ? AND origin != ?"
+            )
+            params = [self._last_id, top, self.origin]
+            use_in = len(subscribed) <= self.MAX_IN_FILTER
+            if use_in:
+                sql += " AND convo_id IN (%s)" % ",".join("?" * len(subscribed))
+                params.extend(subscribed)
+            rows = self._conn.execute(sql + " ORDER BY id", params).fetchall()
+        if not use_in:
+            wanted = set(subscribed)
+            rows = [r for r in rows if r[1] in wanted]
+        return rows, top
+
+    def _prune(self):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,)
+            )
+
+    # ---- Broker interface ----
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self._conn, self._last_id = await asyncio.to_thread(self._open)
+        self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+        await super().stop()
+
+    async def publish(self, convo_id: int, payload: dict):
+        await super().publish(convo_id, payload)
+        await asyncio.to_thread(self._insert, convo_id, json.dumps(payload))
+
+    async def _poll_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                rows, top = await asyncio.to_thread(self._fetch, list(self.subscriptions))
+                for _, convo_id, text in rows:
+                    try:
+                        if self._handler:
+                            await self._handler(convo_id, json.loads(text))
+                    except Exception as exc:
+                        # skip the event: retrying it would replay the whole
+                        # batch to everyone else on every poll
+                        event(
+                            log, "broker_deliver_failed", logging.ERROR,
+                            conversation_id=convo_id, error=repr(exc),
+                        )
+                self._last_id = max(self._last_id, top)
+
+                if time.monotonic() - last_prune > self.retention / 2:
+                    await asyncio.to_thread(self._prune)
+                    last_prune = time.monotonic()
+            except sqlite3.Error as exc:
+                event(log, "broker_poll_failed", logging.WARNING, error=str(exc))
+            except Exception as exc:
+                # anything else must not end cross-worker relaying either
+                event(log, "broker_poll_failed", logging.ERROR, error=repr(exc))
+
+
+def broker_from_env() -> Broker:
+    kind = os.getenv("CHAT_BROKER", "memory")
+    if kind == "sqlite":
+        return SqliteBroker(os.getenv("CHAT_BROKER_PATH", "./broker.db"))
+    return Broker()
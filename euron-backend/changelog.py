@@ -0,0 +1,120 @@
+# changelog.py
+# Change sequence for delta sync (GET /sync?since=<seq>).
+#
+# Every new conversation, participant and message appends a row to the
+# `changes` table via triggers, inside the same transaction as the write.
+# SQLite runs one write transaction at a time, so seq order is commit order
+# and a reader never sees seq N+1 without N. A client keeps the last seq it
+# has seen and asks for everything after it; what comes back is limited to
+# conversations the caller is currently a member of.
+#
+# When the table is first created on an existing users.db, it is seeded
+# with one row per existing conversation, participant and message (in
+# creation order), so since=0 is a complete replay there too.
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import models
+
+CHANGELOG_DDL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_conversation_ai AFTER INSERT ON conversations BEGIN
+        INSERT INTO changes(conversation_id, kind, ref_id)
+        VALUES (new.id, 'conversation', new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_member_ai AFTER INSERT ON conversation_participants BEGIN
+        INSERT INTO changes(conversation_id, kind, ref_id)
+        VALUES (new.conversation_id, 'member', new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_message_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO changes(conversation_id, kind, ref_id)
+        VALUES (new.conversation_id, 'message', new.id);
+    END
+    """,
+]
+
+_SEED_SQL = """
+    INSERT INTO changes(conversation_id, kind, ref_id, created_at)
+    SELECT conversation_id, kind, ref_id, created_at FROM (
+        SELECT id AS conversation_id, 'conversation' AS kind, id AS ref_id,
+               created_at, 0 AS k
+        FROM conversations
+        UNION ALL
+        SELECT conversation_id, 'member', id, joined_at, 1
+        FROM conversation_participants
+        UNION ALL
+        SELECT conversation_id, 'message', id, created_at, 2
+        FROM messages
+    )
+    ORDER BY created_at, k, ref_id
+"""
+
+
+def ensure_changelog(engine):
+    """Install the triggers; seed the log from existing rows the first time."""
+    with engine.begin() as conn:
+        installed = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='changes_message_ai'")
+        ).first()
+        for ddl in CHANGELOG_DDL:
+            conn.execute(text(ddl))
+        if not installed and not conn.execute(text("SELECT 1 FROM changes LIMIT 1")).first():
+            conn.execute(text(_SEED_SQL))
+
+
+def head_seq(db: Session) -> int:
+    return db.execute(text("SELECT coalesce(max(seq), 0) FROM changes")).scalar()
+
+
+def changes_since(
+    db: Session, user_id: int, since: int, limit: int
+) -> Tuple[List[models.Change], bool]:
+    """Up to `limit` changes after `since` in the user's conversations, oldest first.
+
+    Returns (changes, has_more).
+    """
+    C = models.Change
+    P = models.ConversationParticipant
+    rows = (
+        db.query(C)
+        .filter(
+            C.seq > since,
+            C.conversation_id.in_(
+                db.query(P.conversation_id).filter(P.user_id == user_id)
+            ),
+        )
+        .order_by(C.seq)
+        .limit(limit + 1)
+        .all()
+    )
+    return rows[:limit], len(rows) > limit
+
+
+def load_messages(db: Session, message_ids: List[int]):
+    """Messages (with sender names) in id order."""
+    if not message_ids:
+        return []
+    return (
+        db.query(models.Message, models.User.name)
+        .outerjoin(models.User, models.User.id == models.Message.sender_id)
+        .filter(models.Message.id.in_(message_ids))
+        .order_by(models.Message.id)
+        .all()
+    )
+
+
+def load_members(db: Session, participant_ids: List[int]):
+    if not participant_ids:
+        return []
+    return (
+        db.query(models.ConversationParticipant)
+        .filter(models.ConversationParticipant.id.in_(participant_ids))
+        .order_by(models.ConversationParticipant.id)
+        .all()
+    )
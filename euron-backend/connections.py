@@ -0,0 +1,419 @@
+# connections.py
+# WebSocket connection manager.
+#
+# Every socket gets its own bounded outbound queue drained by a writer task,
+# so broadcasting only enqueues and never waits on a slow client. A client
+# whose queue overflows, or whose send takes longer than the deadline, is
+# disconnected instead of holding up everyone else. The writer sends
+# everything queued at wakeup under one deadline.
+#
+# Two kinds of socket:
+#
+# * /ws/{convo_id}  one conversation per socket (the original endpoint).
+# * /ws             one multiplexed socket per user tab, subscribed to any
+#                   number of conversations. These are also indexed by user,
+#                   so a user who joins a conversation gets subscribed on
+#                   every worker through the broker's user channel.
+#
+# Either kind speaks JSON text frames, or binary msgpack frames if the
+# client offered the "msgpack" subprotocol (see wire.py). A client that
+# connects with ?batch=1 may get several events in one {"type": "batch"}
+# frame when a large group is busy (see fanout.py).
+#
+# Heartbeat: a sweeper task pings every socket with {"type": "ping"} every
+# CHAT_WS_PING_INTERVAL seconds. A client that answers {"type": "pong"} (or
+# sends anything at all) is marked live; once it has answered a ping it is
+# closed after CHAT_WS_IDLE_TIMEOUT seconds of silence, which catches
+# half-open sockets whose TCP connection died without a FIN. Clients that
+# never answer pings (older builds) are not idle-reaped; for those uvicorn's
+# protocol-level ping (--ws-ping-interval / --ws-ping-timeout) ends the
+# receive loop, and a ping queued into a dead socket fails its send. The
+# sweeper also drops any socket whose writer died without unregistering.
+#
+# Fan-out time, send failures, evictions and reaps are exported on /metrics.
+import os
+import asyncio
+import logging
+import time
+from typing import Optional, Dict, Iterable, Set
+
+from fastapi import WebSocket
+
+import wire
+import metrics
+from broker import Broker
+from fanout import Fanout
+from logs import get_logger, event
+
+log = get_logger("ws")
+
+WS_QUEUE_SIZE = int(os.getenv("CHAT_WS_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("CHAT_WS_SEND_TIMEOUT", "5"))
+WS_PING_INTERVAL = float(os.getenv("CHAT_WS_PING_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.getenv("CHAT_WS_IDLE_TIMEOUT", "60"))
+WS_SWEEP_INTERVAL = float(os.getenv("CHAT_WS_SWEEP_INTERVAL", "5"))
+
+# close code for clients we evict for not keeping up ("try again later")
+SLOW_CONSUMER_CLOSE = 1013
+# close code for clients reaped for going silent ("going away")
+IDLE_CLOSE = 1001
+
+
+def _wants_batch(websocket: WebSocket) -> bool:
+    return websocket.query_params.get("batch") == "1"
+
+
+def user_channel(user_id: int) -> int:
+    # broker channels are conversation ids; per-user events go on negative ones
+    return -user_id
+
+
+class ClientConnection:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: Optional[int] = None,
+        convo_id: Optional[int] = None,
+        fmt: str = wire.JSON,
+        batch: bool = False,
+        max_queue: int = WS_QUEUE_SIZE,
+        send_timeout: float = WS_SEND_TIMEOUT,
+    ):
+        # convo_id is set for single-conversation sockets, None when multiplexed
+        self.convo_id = convo_id
+        self.user_id = user_id
+        self.conversations: Set[int] = {convo_id} if convo_id is not None else set()
+        self.websocket = websocket
+        self.fmt = fmt
+        self.batch = batch  # accepts {"type": "batch"} frames
+        self.send_timeout = send_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self._burst_sent = 0
+        self.close_reason: Optional[str] = None
+        # heartbeat: last inbound frame / last ping, and whether it answers pings
+        self.last_seen = self.last_ping = time.monotonic()
+        self.heartbeat = False
+        self._closed = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._on_close = None
+
+    def start(self, on_close):
+        self._on_close = on_close
+        self._writer = asyncio.create_task(self._drain())
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def enqueue(self, frame) -> bool:
+        """Queue an already encoded frame (str for JSON, bytes for msgpack)."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.ws_send_failures.inc("queue_overflow")
+            self.evict("queue_overflow")
+            return False
+
+    def send(self, payload: dict) -> bool:
+        """Encode a payload for this socket alone and queue it."""
+        return self.enqueue(wire.encode(payload, self.fmt))
+
+    async def _drain(self):
+        while True:
+            frames = [await self.queue.get()]
+            # take whatever else is already queued: one deadline (and one
+            # wait_for task) per wakeup instead of per frame
+            while not self.queue.empty():
+                frames.append(self.queue.get_nowait())
+            try:
+                await asyncio.wait_for(self._send_all(frames), timeout=self.send_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += len(frames) - self._burst_sent
+                metrics.ws_send_failures.inc("send_timeout")
+                self.evict("send_timeout")
+                return
+            except Exception:
+                self.dropped += len(frames) - self._burst_sent
+                metrics.ws_send_failures.inc("send_failed")
+                self.evict("send_failed")
+                return
+
+    async def _send_all(self, frames):
+        self._burst_sent = 0
+        for frame in frames:
+            if isinstance(frame, bytes):
+                await self.websocket.send_bytes(frame)
+            else:
+                await self.websocket.send_text(frame)
+            self.sent += 1
+            self._burst_sent += 1
+
+    def touch(self, pong: bool = False):
+        """The client sent a frame; pong=True if it was a heartbeat reply."""
+        self.last_seen = time.monotonic()
+        if pong:
+            self.heartbeat = True
+
+    @property
+    def writer_dead(self):
+        return self._writer is not None and self._writer.done()
+
+    def evict(self, reason: str, code: int = SLOW_CONSUMER_CLOSE):
+        """Stop sending and close the socket in the background."""
+        if self.closed:
+            return
+        self.close_reason = reason
+        self._shutdown()
+        asyncio.create_task(self._close_socket(code))
+
+    def close(self):
+        """The client went away; just stop the writer."""
+        if not self.closed:
+            self.close_reason = self.close_reason or "client_closed"
+            self._shutdown()
+
+    def _shutdown(self):
+        self._closed.set()
+        if self._writer and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if self._on_close:
+            self._on_close(self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    @property
+    def multiplexed(self):
+        return self.convo_id is None
+
+    def stats(self):
+        return {
+            "conversation_id": self.convo_id,
+            "user_id": self.user_id,
+            "format": self.fmt,
+            "subscriptions": len(self.conversations),
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "heartbeat": self.heartbeat,
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+        }
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        broker: Optional[Broker] = None,
+        ping_interval: float = WS_PING_INTERVAL,
+        idle_timeout: float = WS_IDLE_TIMEOUT,
+        sweep_interval: float = WS_SWEEP_INTERVAL,
+    ):
+        self.active_connections: Dict[int, Set[ClientConnection]] = {}
+        # multiplexed sockets by user, for conversation-joined events
+        self.user_connections: Dict[int, Set[ClientConnection]] = {}
+        self.broker = broker or Broker()
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.evicted = 0
+        self.dropped_total = 0
+        self.reaped: Dict[str, int] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.fanout = Fanout(lambda convo_id: list(self.active_connections.get(convo_id, ())))
+
+    async def start(self):
+        await self.broker.start(self._deliver_local)
+        if self.sweep_interval > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        await self.fanout.stop()
+        await self.broker.stop()
+
+    async def connect(
+        self, convo_id: int, websocket: WebSocket, user_id: Optional[int] = None
+    ) -> ClientConnection:
+        """Single-conversation socket (/ws/{convo_id})."""
+        subprotocol, fmt = wire.pick_subprotocol(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        conn = ClientConnection(
+            websocket, user_id=user_id, convo_id=convo_id, fmt=fmt, batch=_wants_batch(websocket)
+        )
+        self._add(conn, convo_id)
+        conn.start(self._remove)
+        event(log, "ws_connected", sample=True, conversation_id=convo_id, user_id=user_id,
+              total=len(self.active_connections[convo_id]))
+        return conn
+
+    async def connect_user(
+        self, user_id: int, websocket: WebSocket, convo_ids: Iterable[int]
+    ) -> ClientConnection:
+        """Multiplexed socket (/ws) subscribed to convo_ids."""
+        subprotocol, fmt = wire.pick_subprotocol(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        conn = ClientConnection(websocket, user_id=user_id, fmt=fmt, batch=_wants_batch(websocket))
+        for convo_id in convo_ids:
+            self._add(conn, convo_id)
+        conns = self.user_connections.setdefault(user_id, set())
+        if not conns:
+            self.broker.subscribe(user_channel(user_id))
+        conns.add(conn)
+        conn.start(self._remove)
+        event(log, "ws_connected", sample=True, user_id=user_id,
+              conversations=len(conn.conversations))
+        return conn
+
+    def subscribe(self, conn: ClientConnection, convo_id: int):
+        if not conn.closed and convo_id not in conn.conversations:
+            self._add(conn, convo_id)
+
+    def unsubscribe(self, conn: ClientConnection, convo_id: int):
+        if convo_id in conn.conversations:
+            self._discard(conn, convo_id)
+
+    def _add(self, conn: ClientConnection, convo_id: int):
+        conn.conversations.add(convo_id)
+        conns = self.active_connections.setdefault(convo_id, set())
+        if not conns:
+            self.broker.subscribe(convo_id)
+        conns.add(conn)
+
+    def _discard(self, conn: ClientConnection, convo_id: int):
+        conn.conversations.discard(convo_id)
+        conns = self.active_connections.get(convo_id)
+        if conns and conn in conns:
+            conns.remove(conn)
+            if not conns:
+                self.active_connections.pop(convo_id, None)
+                self.broker.unsubscribe(convo_id)
+
+    def disconnect(self, conn: ClientConnection):
+        conn.close()
+        event(log, "ws_disconnected", sample=True, conversation_id=conn.convo_id,
+              user_id=conn.user_id, sent=conn.sent)
+
+    def _remove(self, conn: ClientConnection):
+        self.dropped_total += conn.dropped
+        if conn.close_reason != "client_closed":
+            self.evicted += 1
+            metrics.ws_evictions.inc(conn.close_reason)
+            event(log, "ws_evicted", logging.WARNING, conversation_id=conn.convo_id,
+                  user_id=conn.user_id, reason=conn.close_reason, dropped=conn.dropped)
+        for convo_id in list(conn.conversations):
+            self._discard(conn, convo_id)
+        if conn.multiplexed:
+            conns = self.user_connections.get(conn.user_id)
+            if conns and conn in conns:
+                conns.remove(conn)
+                if not conns:
+                    self.user_connections.pop(conn.user_id, None)
+                    self.broker.unsubscribe(user_channel(conn.user_id))
+
+    async def broadcast_to_conversation(self, convo_id: int, payload: dict):
+        # the broker delivers to this worker's sockets and relays to the others
+        await self.broker.publish(convo_id, payload)
+
+    async def notify_joined(self, convo_id: int, user_ids: Iterable[int]):
+        """Tell users they are now in convo_id; their /ws sockets subscribe to it."""
+        for user_id in user_ids:
+            await self.broker.publish(
+                user_channel(user_id),
+                {"type": "conversation_joined", "conversation_id": convo_id},
+            )
+
+    async def _deliver_local(self, channel: int, payload: dict):
+        if channel < 0:
+            conns = list(self.user_connections.get(-channel, []))
+            if payload.get("type") == "conversation_joined":
+                for conn in conns:
+                    self.subscribe(conn, payload["conversation_id"])
+            # encode once per format in use, not once per socket
+            frames = {}
+            for conn in conns:
+                frame = frames.get(conn.fmt)
+                if frame is None:
+                    frame = frames[conn.fmt] = wire.encode(payload, conn.fmt)
+                conn.enqueue(frame)
+        else:
+            # inline for small groups, sharded and coalesced for large ones
+            self.fanout.deliver(channel, payload)
+
+    # ---- heartbeat / reaping ----
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as exc:
+                event(log, "ws_sweep_failed", logging.ERROR, error=repr(exc))
+
+    def sweep(self):
+        """Ping sockets that are due, reap silent and dead ones."""
+        now = time.monotonic()
+        for conn in self._all_connections():
+            if conn.closed or conn.writer_dead:
+                # should have unregistered itself; don't keep fanning out to it
+                self._reap(conn, "stale")
+            elif conn.heartbeat and now - conn.last_seen > self.idle_timeout:
+                self._reap(conn, "idle_timeout")
+            elif now - conn.last_ping >= self.ping_interval:
+                conn.last_ping = now
+                conn.send({"type": "ping"})
+
+    def _reap(self, conn: ClientConnection, reason: str):
+        self.reaped[reason] = self.reaped.get(reason, 0) + 1
+        metrics.ws_reaped.inc(reason)
+        if conn.closed:
+            self._remove(conn)
+        else:
+            conn.evict(reason, IDLE_CLOSE)
+
+    def _all_connections(self) -> Set[ClientConnection]:
+        return (
+            {c for conns in self.active_connections.values() for c in conns}
+            | {c for conns in self.user_connections.values() for c in conns}
+        )
+
+    def connection_count(self) -> int:
+        return len(self._all_connections())
+
+    def heartbeat_count(self) -> int:
+        return sum(1 for c in self._all_connections() if c.heartbeat)
+
+    def stats(self, user_id: Optional[int] = None):
+        # aggregates cover every socket; the per-connection list only the
+        # given user's (all of them when user_id is None)
+        connections = [c.stats() for c in self._all_connections()]
+        return {
+            "connections": [
+                c for c in connections if user_id is None or c["user_id"] == user_id
+            ],
+            "users": len(self.user_connections),
+            "subscriptions": sum(len(conns) for conns in self.active_connections.values()),
+            "total_queued": sum(c["queue_depth"] for c in connections),
+            "total_dropped": self.dropped_total + sum(c["dropped"] for c in connections),
+            "evicted": self.evicted,
+            "reaped": dict(self.reaped),
+            "fanout": self.fanout.stats(),
+        }
@@ -1,12 +1,194 @@
-from sqlalchemy import create_engine
+# Two ways into the same users.db:
+#
+# * engine / SessionLocal (sync). Used by plain `def` endpoints through
+#   utilities.get_convo_db (or get_db outside a conversation); FastAPI runs
+#   those in its threadpool, so blocking on SQLite there only ties up a
+#   worker thread.
+# * async_read_engine / AsyncReadSessionLocal (aiosqlite, reads only). Used
+#   by `async def` endpoints and WebSocket handlers - through
+#   utilities.get_async_convo_db for anything under a conversation (it picks
+#   the owning shard, see shards.py), get_async_read_db for the users
+#   directory. Those run on the event loop, and a blocking query there
+#   stalls every socket and request on the worker.
+#
+# Rule: an endpoint declared `async def` must only use the async session,
+# and only to read. Its writes go to SessionLocal in a thread
+# (asyncio.to_thread), or to a background writer that already runs in one
+# (the group-commit writer, read_tracker's flush). Everything else stays
+# `def` + get_db.
+#
+# That keeps a single writer connection per database file per process: the
+# sync writer engine's one pooled connection. Writers queue on that pool in
+# FIFO order instead of a second connection racing them for the WAL lock
+# and spinning in busy_timeout.
+#
+# Storage profile (CHAT_DB_PROFILE):
+#
+# * "legacy"    one default engine, rollback journal - the original setup.
+# * "wal"       (default) WAL journal, one serialized writer connection and
+#               a pool of query_only reader connections, so history reads
+#               never block message inserts. synchronous=FULL keeps the
+#               same durability as the rollback journal.
+# * "wal-fast"  like "wal" with synchronous=NORMAL: a power loss can drop
+#               the last commits (never corrupts), in exchange for fewer
+#               fsyncs.
+#
+# The sync side has a writer and a reader session factory; get_db and
+# get_convo_db pick one per request (GET -> reader).
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
-DATABASE_URL = "sqlite:///./users.db"
+DATABASE_PATH = os.getenv("CHAT_DATABASE_PATH", "./users.db")
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
+STORAGE_PROFILES = {
+    "legacy": None,
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative = KiB, so 64 MiB
+        "busy_timeout": 5000,
+        "reader_pool_size": 8,
+    },
+    "wal-fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        "reader_pool_size": 8,
+    },
+}
+
+STORAGE_PROFILE = os.getenv("CHAT_DB_PROFILE", "wal")
+
+
+def _apply_pragmas(engine, profile: dict, read_only: bool):
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            # journal_mode is stored in the file; the writer sets it once
+            cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+        cursor.execute(f"PRAGMA synchronous={profile['synchronous']}")
+        cursor.execute(f"PRAGMA mmap_size={profile['mmap_size']}")
+        cursor.execute(f"PRAGMA cache_size={profile['cache_size']}")
+        cursor.execute(f"PRAGMA busy_timeout={profile['busy_timeout']}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def build_engines(path: str = DATABASE_PATH, profile_name: str = STORAGE_PROFILE):
+    """Return (writer, reader) sync engines for a database file."""
+    if profile_name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile {profile_name!r}")
+    profile = STORAGE_PROFILES[profile_name]
+    url = f"sqlite:///{path}"
+
+    if profile is None:
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+        return engine, engine
+
+    # SQLite allows one writer at a time anyway; one connection makes
+    # writers queue in the pool instead of spinning on SQLITE_BUSY
+    writer = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=30,
+    )
+    _apply_pragmas(writer, profile, read_only=False)
+
+    reader = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        pool_size=profile["reader_pool_size"],
+        max_overflow=profile["reader_pool_size"],
+        pool_timeout=30,
+    )
+    _apply_pragmas(reader, profile, read_only=True)
+    return writer, reader
+
+
+def build_async_engine(path: str = DATABASE_PATH, profile_name: str = STORAGE_PROFILE):
+    """Return the async (reader) engine for a database file.
+
+    There is deliberately no async writer, see the top of this file.
+    """
+    profile = STORAGE_PROFILES[profile_name]
+    url = f"sqlite+aiosqlite:///{path}"
+
+    if profile is None:
+        return create_async_engine(url, pool_size=10, max_overflow=20, pool_timeout=30)
+
+    reader = create_async_engine(
+        url,
+        pool_size=profile["reader_pool_size"],
+        max_overflow=profile["reader_pool_size"],
+        pool_timeout=30,
+    )
+    _apply_pragmas(reader.sync_engine, profile, read_only=True)
+    return reader
+
+
+engine, read_engine = build_engines()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+async_read_engine = build_async_engine()
+
+AsyncReadSessionLocal = async_sessionmaker(
+    async_read_engine, autoflush=False, expire_on_commit=False
+)
+
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
 
 Base = declarative_base()
+
+
+def create_missing_indexes(bind=engine, tables=None):
+    # create_all() only builds indexes together with new tables; this picks up
+    # indexes added to existing tables in users.db files created earlier.
+    # Existing ones are looked up by name: SQLAlchemy can't reflect
+    # expression indexes, so checkfirst=True would try to recreate them.
+    with bind.begin() as conn:
+        existing = {
+            name for (name,) in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+        for table in tables or Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+
+
+def add_missing_columns(bind=engine, tables=None):
+    # Same idea for columns: create_all() never alters an existing table, so
+    # nullable columns added to a model later are ALTERed into old users.db
+    # files here.
+    with bind.begin() as conn:
+        for table in tables or Base.metadata.sorted_tables:
+            existing = {
+                row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")
+            }
+            if not existing:
+                continue
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=conn.dialect)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"
+                )
+
+
+async def dispose_engines():
+    await async_read_engine.dispose()
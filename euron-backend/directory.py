@@ -0,0 +1,190 @@
+# directory.py
+# User directory search for the ChatPage "find people" box.
+#
+# Results come in three tiers, each read off an index so a keystroke costs
+# O(log users + page) instead of a scan of the users table:
+#
+#   1. name starts with the query    -> ix_users_name_lower (lower(name))
+#   2. email starts with the query   -> ix_users_email_lower (lower(email))
+#   3. name/email contains the query -> users_fts (FTS5 trigram index)
+#
+# Trigrams can't match queries shorter than 3 characters, so for those
+# tier 3 falls back to a LIKE scan of users (e.g. "@x", "1@").
+#
+# Tiers 1 and 2 are ordered by their (lowercased) key, then id; tier 3 by
+# id alone, which FTS5 yields in rowid order without sorting the matches.
+# Keyset cursors are "tier|key|id".
+#
+# users_fts is an external-content table over users(name, email) kept in
+# step by triggers, so add_new_user (or any other insert/update) needs no
+# extra call. Rebuild for an existing users.db with:
+#
+#   python directory.py rebuild
+import sys
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# trigram needs at least 3 characters to match anything
+MIN_SUBSTRING = 3
+
+# sorts after every valid UTF-8 character, so [q, q + _TOP) is "starts with q"
+_TOP = "\U0010ffff"
+
+USERS_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        name,
+        email,
+        content='users',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, name, email) VALUES (new.id, new.name, new.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, email)
+        VALUES ('delete', old.id, old.name, old.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name, email ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, email)
+        VALUES ('delete', old.id, old.name, old.email);
+        INSERT INTO users_fts(rowid, name, email) VALUES (new.id, new.name, new.email);
+    END
+    """,
+]
+
+_NAME_PREFIX = "(lower(u.name) >= :lo AND lower(u.name) < :hi)"
+_EMAIL_PREFIX = "(lower(u.email) >= :lo AND lower(u.email) < :hi)"
+
+# "not already in an earlier tier"; IS NOT 1 rather than NOT, which would be
+# NULL (so false) for users without a name
+_NOT_NAME_PREFIX = f"{_NAME_PREFIX} IS NOT 1"
+_NOT_EMAIL_PREFIX = f"{_EMAIL_PREFIX} IS NOT 1"
+
+# tier -> (sort key or None for id order, id column, FROM clause, WHERE clause)
+_TIERS = {
+    1: ("lower(u.name)", "u.id", "users u", _NAME_PREFIX),
+    2: ("lower(u.email)", "u.id", "users u", f"{_EMAIL_PREFIX} AND {_NOT_NAME_PREFIX}"),
+    3: (
+        None,
+        "users_fts.rowid",
+        "users_fts JOIN users u ON u.id = users_fts.rowid",
+        f"users_fts MATCH :match AND {_NOT_NAME_PREFIX} AND {_NOT_EMAIL_PREFIX}",
+    ),
+}
+
+# tier 3 for queries too short for the trigram index: a scan
+_SHORT_SUBSTRING = (
+    None,
+    "u.id",
+    "users u",
+    "(lower(u.name) LIKE :like ESCAPE '\\' OR lower(u.email) LIKE :like ESCAPE '\\')"
+    f" AND {_NOT_NAME_PREFIX} AND {_NOT_EMAIL_PREFIX}",
+)
+
+
+def _like_pattern(q: str) -> str:
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def ensure_users_fts(engine):
+    """Create the trigram table and triggers; index existing users the first time."""
+    with engine.begin() as conn:
+        existed = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'")
+        ).first()
+        for ddl in USERS_FTS_DDL:
+            conn.execute(text(ddl))
+        if not existed:
+            conn.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+
+
+def rebuild(engine):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO users_fts(users_fts) VALUES ('optimize')"))
+
+
+def encode_cursor(tier: int, key: str, row_id: int) -> str:
+    return f"{tier}|{key}|{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str, int]:
+    try:
+        tier, rest = cursor.split("|", 1)
+        key, row_id = rest.rsplit("|", 1)
+        tier = int(tier)
+        if tier not in _TIERS:
+            raise ValueError(tier)
+        return tier, key, int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def search_users(db: Session, q: Optional[str], limit: int, cursor: Optional[str] = None):
+    """One page of users matching q, best tier first. Returns (rows, next_cursor)."""
+    q = (q or "").strip().lower()
+    params = {"lo": q, "hi": q + _TOP}
+    if len(q) >= MIN_SUBSTRING:
+        params["match"] = '"' + q.replace('"', '""') + '"'
+    elif q:
+        params["like"] = _like_pattern(q)
+
+    if cursor:
+        start_tier, after_key, after_id = decode_cursor(cursor)
+    else:
+        start_tier, after_key, after_id = 1, None, None
+
+    rows = []
+    for tier in range(start_tier, len(_TIERS) + 1):
+        if tier == 3 and not q:
+            break  # the empty query is all users, already listed by tiers 1-2
+        if tier == 3 and "like" in params:
+            key, id_col, source, where = _SHORT_SUBSTRING
+        else:
+            key, id_col, source, where = _TIERS[tier]
+        sort_key = key or "''"
+        sql = f"SELECT u.id, u.name, u.email, {sort_key} AS sort_key FROM {source} WHERE {where}"
+        tier_params = dict(params, n=limit - len(rows))
+        if tier == start_tier and after_id is not None:
+            if key:
+                sql += f" AND ({key}, u.id) > (:after_key, :after_id)"
+                tier_params["after_key"] = after_key
+            else:
+                sql += f" AND {id_col} > :after_id"
+            tier_params["after_id"] = after_id
+        sql += f" ORDER BY {key}, u.id LIMIT :n" if key else f" ORDER BY {id_col} LIMIT :n"
+
+        rows.extend((tier, r) for r in db.execute(text(sql), tier_params).mappings())
+        if len(rows) >= limit:
+            break
+
+    next_cursor = None
+    if len(rows) >= limit:
+        tier, last = rows[-1]
+        next_cursor = encode_cursor(tier, last["sort_key"], last["id"])
+
+    return [r for _, r in rows], next_cursor
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python directory.py rebuild")
+        sys.exit(2)
+    from database import engine
+    ensure_users_fts(engine)
+    rebuild(engine)
+    with engine.connect() as conn:
+        n = conn.execute(text("SELECT COUNT(*) FROM users")).scalar()
+    print(f"users_fts rebuilt over {n} users")
@@ -0,0 +1,147 @@
+# fanout.py
+# Delivering one broker event to this worker's sockets.
+#
+# Delivery itself never awaits a socket: each ClientConnection has its own
+# queue and writer task (connections.py), so fan-out is "encode once per
+# format, enqueue per socket". What costs is the enqueue walk: for a group
+# with thousands of local subscribers it is one long synchronous loop per
+# message, and nothing else on the worker runs until it finishes.
+#
+# So conversations with at least CHAT_FANOUT_LARGE local subscribers take
+# the sharded path:
+#
+# * the first event starts a flusher for that conversation, which waits
+#   CHAT_FANOUT_COALESCE_MS; events arriving meanwhile queue up behind it
+#   and go out together (coalescing);
+# * subscribers are walked in shards of CHAT_FANOUT_SHARD_SIZE, yielding to
+#   the event loop between shards;
+# * at most CHAT_FANOUT_CONCURRENCY large conversations are walked at once,
+#   the rest wait for a slot.
+#
+# Sockets opened with ?batch=1 get coalesced events as one frame,
+# {"type": "batch", "events": [...]}; everyone else gets them one by one,
+# in order. Small conversations are delivered inline, as before.
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Sequence
+
+import metrics
+import wire
+
+FANOUT_LARGE = int(os.getenv("CHAT_FANOUT_LARGE", "500"))
+FANOUT_SHARD_SIZE = int(os.getenv("CHAT_FANOUT_SHARD_SIZE", "256"))
+FANOUT_CONCURRENCY = int(os.getenv("CHAT_FANOUT_CONCURRENCY", "4"))
+FANOUT_COALESCE = float(os.getenv("CHAT_FANOUT_COALESCE_MS", "5")) / 1000
+
+
+class _Frames:
+    """Encoded frames for a run of events, built once per format on demand."""
+
+    def __init__(self, events: List[dict]):
+        self.events = events
+        self._single: Dict[str, list] = {}
+        self._batch: Dict[str, object] = {}
+
+    def single(self, fmt: str) -> list:
+        frames = self._single.get(fmt)
+        if frames is None:
+            frames = self._single[fmt] = [wire.encode(e, fmt) for e in self.events]
+        return frames
+
+    def batch(self, fmt: str):
+        frame = self._batch.get(fmt)
+        if frame is None:
+            frame = self._batch[fmt] = wire.encode({"type": "batch", "events": self.events}, fmt)
+        return frame
+
+    def enqueue(self, conns: Sequence):
+        many = len(self.events) > 1
+        for conn in conns:
+            if many and conn.batch:
+                conn.enqueue(self.batch(conn.fmt))
+            else:
+                for frame in self.single(conn.fmt):
+                    if not conn.enqueue(frame):
+                        break
+
+
+class Fanout:
+    def __init__(
+        self,
+        subscribers: Callable[[int], list],
+        large: int = FANOUT_LARGE,
+        shard_size: int = FANOUT_SHARD_SIZE,
+        concurrency: int = FANOUT_CONCURRENCY,
+        coalesce: float = FANOUT_COALESCE,
+    ):
+        self._subscribers = subscribers
+        self.large = large
+        self.shard_size = max(1, shard_size)
+        self.coalesce = coalesce
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._pending: Dict[int, List[dict]] = {}
+        self._flushers: Dict[int, asyncio.Task] = {}
+        self.direct = 0
+        self.sharded = 0
+        self.events_coalesced = 0
+        self.shards = 0
+
+    def deliver(self, channel: int, payload: dict):
+        if channel in self._pending:
+            # a flush for this conversation is waiting or running; keep order
+            self._pending[channel].append(payload)
+            return
+        conns = self._subscribers(channel)
+        if not conns:
+            return
+        if len(conns) < self.large:
+            start = time.perf_counter()
+            _Frames([payload]).enqueue(conns)
+            self.direct += 1
+            metrics.broadcast_fanout.observe(time.perf_counter() - start)
+            return
+        self._pending[channel] = [payload]
+        self._flushers[channel] = asyncio.create_task(self._flush(channel))
+
+    async def _flush(self, channel: int):
+        try:
+            if self.coalesce > 0:
+                await asyncio.sleep(self.coalesce)
+            async with self._slots:
+                while self._pending.get(channel):
+                    events, self._pending[channel] = self._pending[channel], []
+                    await self._walk(channel, events)
+        finally:
+            self._pending.pop(channel, None)
+            self._flushers.pop(channel, None)
+
+    async def _walk(self, channel: int, events: List[dict]):
+        start = time.perf_counter()
+        frames = _Frames(events)
+        conns = self._subscribers(channel)
+        for i in range(0, len(conns), self.shard_size):
+            frames.enqueue(conns[i:i + self.shard_size])
+            self.shards += 1
+            await asyncio.sleep(0)
+        self.sharded += 1
+        self.events_coalesced += len(events) - 1
+        metrics.broadcast_fanout.observe(time.perf_counter() - start)
+
+    async def stop(self):
+        for task in list(self._flushers.values()):
+            task.cancel()
+        self._flushers.clear()
+        self._pending.clear()
+
+    def stats(self):
+        return {
+            "large_threshold": self.large,
+            "shard_size": self.shard_size,
+            "coalesce_ms": self.coalesce * 1000,
+            "direct": self.direct,
+            "sharded": self.sharded,
+            "shards": self.shards,
+            "events_coalesced": self.events_coalesced,
+            "pending_conversations": len(self._pending),
+        }
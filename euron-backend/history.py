@@ -0,0 +1,136 @@
+# history.py
+# Keyset-paginated message history.
+#
+# Pages are located with the (conversation_id, created_at, id) index, so the
+# cost of a page does not depend on how long the conversation is. Pages that
+# run past the oldest live message continue into the conversation's archived
+# prefix (archive.py), so clients page through old history the same way.
+#
+# export_ndjson streams a whole conversation instead: one query joined with
+# users, read EXPORT_CHUNK rows at a time and written out as JSON lines, so
+# memory stays flat however long the history is. Archived blocks come first.
+import json
+from typing import Iterator, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import or_, and_, select
+from sqlalchemy.orm import Session, joinedload
+
+import models
+import archive
+from pagination import encode_cursor, decode_cursor
+
+EXPORT_CHUNK = 1000
+
+
+def page_messages(
+    db: Session,
+    convo_id: int,
+    limit: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    """Return (messages oldest-first, next_cursor).
+
+    No cursor: the newest `limit` messages; next_cursor pages further back.
+    before=c: the `limit` messages just older than c; next_cursor pages back.
+    after=c: the `limit` messages just newer than c; next_cursor pages forward.
+    next_cursor is None when there is nothing more in that direction.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after")
+
+    M = models.Message
+    q = (
+        db.query(M)
+        .options(joinedload(M.sender))
+        .filter(M.conversation_id == convo_id)
+    )
+
+    if after:
+        ts, msg_id = decode_cursor(after)
+        rows = []
+        high = archive.high_key(db, convo_id)
+        if high is not None and (ts, msg_id) < high:
+            # the cursor is inside the archived prefix
+            rows = archive.read_after(db, convo_id, (ts, msg_id), limit + 1)
+        if len(rows) <= limit:
+            q = q.filter(or_(M.created_at > ts, and_(M.created_at == ts, M.id > msg_id)))
+            q = q.order_by(M.created_at.asc(), M.id.asc())
+            rows += q.limit(limit + 1 - len(rows)).all()
+    else:
+        key = None
+        if before:
+            ts, msg_id = key = decode_cursor(before)
+            q = q.filter(or_(M.created_at < ts, and_(M.created_at == ts, M.id < msg_id)))
+        q = q.order_by(M.created_at.desc(), M.id.desc())
+        rows = q.limit(limit + 1).all()
+        if len(rows) <= limit:
+            # past the oldest live message: everything older is archived
+            rows += archive.read_before(db, convo_id, key, limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        edge = rows[-1]
+        next_cursor = encode_cursor(edge.created_at, edge.id)
+
+    if not after:
+        rows.reverse()
+    return rows, next_cursor
+
+
+def export_ndjson(session_factory, convo_id: int, chunk: int = EXPORT_CHUNK) -> Iterator[bytes]:
+    """Yield the conversation oldest-first as NDJSON, one chunk of lines at a time.
+
+    Opens its own session: the response is still streaming after the
+    request's dependencies have finished.
+    """
+    M = models.Message
+    stmt = (
+        select(
+            M.id,
+            M.conversation_id,
+            M.sender_id,
+            models.User.name,
+            M.content,
+            M.created_at,
+            M.status,
+        )
+        .outerjoin(models.User, models.User.id == M.sender_id)
+        .where(M.conversation_id == convo_id)
+        .order_by(M.created_at, M.id)
+        .execution_options(yield_per=chunk)
+    )
+    dumps = json.dumps
+
+    def lines(rows):
+        return "".join(
+            dumps({
+                "id": r[0],
+                "conversation_id": r[1],
+                "sender_id": r[2],
+                "sender_name": r[3],
+                "content": r[4],
+                "created_at": r[5].isoformat() if r[5] else None,
+                "status": r[6],
+            }) + "\n"
+            for r in rows
+        ).encode()
+
+    db = session_factory()
+    try:
+        for block in archive.iter_blocks(db, convo_id):
+            names = dict(
+                db.query(models.User.id, models.User.name)
+                .filter(models.User.id.in_({r[1] for r in block}))
+                .all()
+            )
+            yield lines(
+                (r[0], convo_id, r[1], names.get(r[1]), r[2], r[3], r[4]) for r in block
+            )
+        for rows in db.execute(stmt).partitions():
+            yield lines(rows)
+    finally:
+        db.close()
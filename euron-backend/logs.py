@@ -0,0 +1,68 @@
+# logs.py
+# Structured, sampled logging.
+#
+# Every record is one JSON line: {"ts", "level", "logger", "event", ...fields}.
+# High-volume events (logins, socket connects/disconnects) pass a sample rate
+# and only that fraction is written; the record carries "sample" so counts
+# can be scaled back up. Warnings and errors are never sampled. Use /metrics
+# for exact counts - logs are for looking at individual cases.
+#
+#   CHAT_LOG_LEVEL    minimum level (default INFO)
+#   CHAT_LOG_SAMPLE   rate for sampled events, 0..1 (default 0.1)
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("CHAT_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE = float(os.getenv("CHAT_LOG_SAMPLE", "0.1"))
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS:
+                line[key] = value
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def _configure():
+    root = logging.getLogger("chat")
+    if root.handlers:
+        return root
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False  # uvicorn's own handlers would print it again
+    return root
+
+
+_configure()
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"chat.{name}")
+
+
+def event(logger: logging.Logger, name: str, level: int = logging.INFO,
+          sample: bool = False, **fields):
+    """Log one event with key/value fields; sample=True keeps LOG_SAMPLE of them."""
+    if sample and level < logging.WARNING:
+        if LOG_SAMPLE <= 0 or random.random() >= LOG_SAMPLE:
+            return
+        fields["sample"] = LOG_SAMPLE
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra=fields)
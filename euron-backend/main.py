@@ -1,39 +1,80 @@
-import os
-import json
 import asyncio
 from datetime import datetime
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Tuple
 
 from fastapi import (
     FastAPI,
     Depends,
     HTTPException,
-    Path,
     Body,
     status,
     Query,
     WebSocket,
-    WebSocketDisconnect,
+    Response,
+    BackgroundTasks,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session, aliased
-from sqlalchemy import desc
-
-from database import Base, engine, SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import (
+    Base,
+    engine,
+    AsyncReadSessionLocal,
+    create_missing_indexes,
+    add_missing_columns,
+    dispose_engines,
+)
 import models
+import summaries
+import history
+import search
+import directory
+import changelog
+import participants
+import wire
+import metrics
+from membership import membership_index
 from schemas import (
     UserLogin,
     UserSignup,
     ConversationListItem,
     MessageOut,
+    MessageSearchHit,
     SendMessageIn,
+    MarkReadIn,
+    SyncOut,
+    MemberChange,
     UserOut,
     Start1to1In,
     CreateGroupIn
 )
-from utilities import authenticate_user, get_db, add_new_user
-from auth import create_access_token, verify_token
+from utilities import (
+    authenticate_user,
+    get_db,
+    get_async_read_db,
+    get_convo_db,
+    get_async_convo_db,
+    add_new_user,
+)
+from auth import create_access_token, verify_token, revoke_token, revoke_user, token_cache
+from broker import broker_from_env
+from connections import ConnectionManager
+from write_pipeline import message_writer
+from passwords import password_pool
+from receipts import read_tracker, unread_counts
+from recent import recent_messages
+import archive
+from archive import archiver
+from logs import get_logger, event
+from pagination import encode_cursor
+import shards
+from shards import router
+
+log = get_logger("api")
 
 
 # --------------------------------------------------
@@ -41,8 +82,40 @@ from auth import create_access_token, verify_token
 # --------------------------------------------------
 
 Base.metadata.create_all(bind=engine)
+add_missing_columns()
+participants.dedupe_participants(engine)
+create_missing_indexes()
+search.ensure_fts(engine)
+directory.ensure_users_fts(engine)
+changelog.ensure_changelog(engine)
+router.ensure_directory()
+
+# with CHAT_SHARDS, conversation data lives in the shard files (shards.py)
+if router.enabled:
+    for shard in router.shards:
+        Base.metadata.create_all(bind=shard.engine, tables=shards.shard_tables())
+        shards.reserve_id_range(shard)
+        add_missing_columns(shard.engine, shards.shard_tables())
+        participants.dedupe_participants(shard.engine)
+        create_missing_indexes(shard.engine, shards.shard_tables())
+        search.ensure_fts(shard.engine)
+        changelog.ensure_changelog(shard.engine)
+
+for shard in router.shards:
+    _db = shard.SessionLocal()
+    try:
+        summaries.backfill_missing(_db)
+        archive.ensure_search_index(_db)
+    finally:
+        _db.close()
 
 app = FastAPI()
+# JSON by default, msgpack for clients sending Accept: application/msgpack
+app.router.route_class = wire.NegotiatedRoute
+
+# per-route latency and SQL statement counts, served on /metrics
+metrics.track_sql()
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -50,6 +123,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 bearer_scheme = HTTPBearer()
@@ -69,88 +143,171 @@ def get_current_user(
 # WebSocket Connection Manager
 # --------------------------------------------------
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, Set[WebSocket]] = {}
-
-    async def connect(self, convo_id: int, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.setdefault(convo_id, set()).add(websocket)
-        print(f"WS connected | convo={convo_id} | total={len(self.active_connections[convo_id])}")
-
-    def disconnect(self, convo_id: int, websocket: WebSocket):
-        conns = self.active_connections.get(convo_id)
-        if conns and websocket in conns:
-            conns.remove(websocket)
-            if not conns:
-                self.active_connections.pop(convo_id, None)
-        print(f"WS disconnected | convo={convo_id}")
-
-    async def broadcast_to_conversation(self, convo_id: int, payload: dict):
-        conns = list(self.active_connections.get(convo_id, []))
-        if not conns:
-            return
+manager = ConnectionManager(broker_from_env())
+metrics.watch_connections(manager)
+metrics.watch_stats("password_pool", "bcrypt pool (passwords.py) on this worker.", password_pool.stats)
+metrics.watch_stats("token_cache", "Verified-token cache (auth.py) on this worker.", token_cache.stats)
+metrics.watch_stats("receipts", "Read-receipt coalescing (receipts.py) on this worker.", read_tracker.stats)
+metrics.watch_stats("history_cache", "Recent-messages ring buffers (recent.py) on this worker.", recent_messages.stats)
+metrics.watch_stats("archive", "Background archival (archive.py) on this worker.", archiver.stats)
+metrics.watch_stats("group_commit", "Group-commit writer (write_pipeline.py) on this worker.", message_writer.stats)
 
-        text = json.dumps(payload)
-        await asyncio.gather(
-            *(self._safe_send(ws, text) for ws in conns),
-            return_exceptions=True,
-        )
 
-    async def _safe_send(self, ws: WebSocket, text: str):
-        try:
-            await ws.send_text(text)
-        except Exception:
-            pass
+@app.on_event("startup")
+async def start_manager():
+    await manager.start()
+    await message_writer.start()
+    await read_tracker.start(manager.broadcast_to_conversation)
+    await archiver.start()
 
 
-manager = ConnectionManager()
+@app.on_event("shutdown")
+async def stop_manager():
+    await archiver.stop()
+    await message_writer.stop()
+    await read_tracker.stop()
+    await manager.stop()
+    await router.dispose()
+    await dispose_engines()
+    password_pool.shutdown()
 
 
 # --------------------------------------------------
-# WebSocket endpoint
+# WebSocket endpoints
 # --------------------------------------------------
 
-@app.websocket("/ws/{convo_id}")
-async def websocket_endpoint(websocket: WebSocket, convo_id: int):
+async def _ws_user(websocket: WebSocket) -> Optional[int]:
+    """user_id from the ?token= query param, or None after closing the socket."""
     token = websocket.query_params.get("token")
-    if not token:
+    payload = verify_token(token) if token else None
+    if not payload:
         await websocket.close(code=1008)
+        return None
+    return payload.get("user_id")
+
+
+async def _is_member(convo_id: int, user_id: int) -> bool:
+    role = membership_index.peek(convo_id, user_id)
+    if role is None:
+        async with router.shard_for(convo_id).AsyncReadSessionLocal() as db:
+            role = await membership_index.arole_of(db, convo_id, user_id)
+    return bool(role)
+
+
+@app.websocket("/ws")
+async def websocket_user_endpoint(websocket: WebSocket):
+    # one socket per client for all of the user's conversations
+    user_id = await _ws_user(websocket)
+    if user_id is None:
         return
 
-    payload = verify_token(token)
-    if not payload:
-        await websocket.close(code=1008)
+    if router.enabled:
+        # gathered from every shard, off the event loop
+        convo_ids = await asyncio.to_thread(membership_index.conversations_of, None, user_id)
+    else:
+        async with AsyncReadSessionLocal() as db:
+            convo_ids = await db.run_sync(membership_index.conversations_of, user_id)
+
+    conn = await manager.connect_user(user_id, websocket, convo_ids)
+    await _serve(conn)
+
+
+@app.websocket("/ws/{convo_id}")
+async def websocket_endpoint(websocket: WebSocket, convo_id: int):
+    user_id = await _ws_user(websocket)
+    if user_id is None:
         return
 
-    user_id = payload.get("user_id")
+    if not await _is_member(convo_id, user_id):
+        await websocket.close(code=1008)
+        return
 
-    db = SessionLocal()
-    try:
-        membership = (
-            db.query(models.ConversationParticipant)
-            .filter(
-                models.ConversationParticipant.conversation_id == convo_id,
-                models.ConversationParticipant.user_id == user_id,
-            )
-            .first()
-        )
-        if not membership:
-            await websocket.close(code=1008)
-            return
-    finally:
-        db.close()
+    conn = await manager.connect(convo_id, websocket, user_id)
+    await _serve(conn)
 
-    await manager.connect(convo_id, websocket)
 
+async def _serve(conn):
+    # read client events until the client leaves or the manager drops it
+    receiver = asyncio.create_task(_receive_events(conn))
+    closed = asyncio.create_task(conn.wait_closed())
     try:
-        # Keep connection alive
-        while True:
-            await asyncio.sleep(60)
-    except WebSocketDisconnect:
-        manager.disconnect(convo_id, websocket)
-    except Exception:
-        manager.disconnect(convo_id, websocket)
+        await asyncio.wait({receiver, closed}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        receiver.cancel()
+        closed.cancel()
+        manager.disconnect(conn)
+
+
+async def _receive_events(conn):
+    # client -> server events:
+    #   {"type": "pong"}                      heartbeat reply to our {"type": "ping"}
+    #   {"type": "ping"}                      client-side heartbeat, answered with a pong
+    #   {"type": "read", "message_id": 123}   read everything up to 123
+    # and on the multiplexed /ws socket, with "conversation_id" on each:
+    #   {"type": "read", "conversation_id": 7, "message_id": 123}
+    #   {"type": "subscribe", "conversation_id": 7}
+    #   {"type": "unsubscribe", "conversation_id": 7}
+    while True:
+        try:
+            message = await conn.websocket.receive()
+        except RuntimeError:
+            return
+        if message["type"] == "websocket.disconnect":
+            return
+        conn.touch()
+        try:
+            # JSON text frames, or msgpack binary frames
+            event = wire.decode(message.get("bytes") or message.get("text") or "")
+        except Exception:
+            continue
+        if not isinstance(event, dict):
+            continue
+
+        kind = event.get("type")
+        if kind == "pong":
+            conn.touch(pong=True)
+            continue
+        if kind == "ping":
+            conn.send({"type": "pong"})
+            continue
+
+        convo_id = event.get("conversation_id") if conn.multiplexed else conn.convo_id
+        if not isinstance(convo_id, int):
+            continue
+
+        if kind == "read":
+            message_id = event.get("message_id")
+            if (
+                convo_id in conn.conversations
+                and isinstance(message_id, int)
+                and message_id > 0
+            ):
+                read_tracker.mark(convo_id, conn.user_id, message_id)
+
+        elif kind == "subscribe" and conn.multiplexed:
+            if await _is_member(convo_id, conn.user_id):
+                manager.subscribe(conn, convo_id)
+                reply = {"type": "subscribed", "conversation_id": convo_id}
+            else:
+                reply = {"type": "error", "conversation_id": convo_id, "detail": "Not a member"}
+            conn.send(reply)
+
+        elif kind == "unsubscribe" and conn.multiplexed:
+            manager.unsubscribe(conn, convo_id)
+            conn.send({"type": "unsubscribed", "conversation_id": convo_id})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # Prometheus scrape target; numbers are for this worker process
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/ws/stats")
+def websocket_stats(current_user: dict = Depends(get_current_user)):
+    # outbound queue depth and drop counters on this worker: totals for all
+    # sockets, per-connection detail for the caller's own only
+    return manager.stats(user_id=current_user["user_id"])
 
 
 # --------------------------------------------------
@@ -158,11 +315,12 @@ async def websocket_endpoint(websocket: WebSocket, convo_id: int):
 # --------------------------------------------------
 
 @app.post("/login")
-def login(request: UserLogin, db: Session = Depends(get_db)):
-    print("inside the login handler python")
-    user = authenticate_user(db, request.email, request.password)
+async def login(request: UserLogin, db: AsyncSession = Depends(get_async_read_db)):
+    user = await authenticate_user(db, request.email, request.password)
     if not user:
+        event(log, "login_failed", sample=True)
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    event(log, "login", sample=True, user_id=user.id)
 
     access_token = create_access_token({"user_id": user.id})
     return {
@@ -172,10 +330,23 @@ def login(request: UserLogin, db: Session = Depends(get_db)):
     }
 
 
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+    current_user: dict = Depends(get_current_user),
+):
+    # this token only; other sessions stay signed in
+    revoke_token(credentials.credentials)
+
+
+@app.post("/logout/all", status_code=status.HTTP_204_NO_CONTENT)
+def logout_everywhere(current_user: dict = Depends(get_current_user)):
+    revoke_user(current_user["user_id"])
+
+
 @app.post("/signup", response_model=UserOut)
-def signup(request: UserSignup, db: Session = Depends(get_db)):
-    print("inside the signup python")
-    return add_new_user(db, request)
+async def signup(request: UserSignup, db: AsyncSession = Depends(get_async_read_db)):
+    return await add_new_user(db, request)
 
 
 @app.get("/me")
@@ -189,82 +360,112 @@ def read_me(current_user: dict = Depends(get_current_user)):
 
 @app.get("/conversations", response_model=List[ConversationListItem])
 def get_conversations(
-    db: Session = Depends(get_db),
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
     current_user: dict = Depends(get_current_user),
 ):
     user_id = current_user["user_id"]
 
-    conversations = (
-        db.query(models.Conversation)
-        .join(models.ConversationParticipant)
-        .filter(models.ConversationParticipant.user_id == user_id)
-        .all()
-    )
-
-    result = []
+    def page(db):
+        rows, next_cursor = summaries.list_for_user(db, user_id, limit, cursor)
+        keys = [(s.last_activity_at, s.conversation_id) for s, _ in rows]
+        return list(zip(keys, _conversation_items(db, user_id, rows))), bool(next_cursor)
+
+    # one page per shard (just users.db unless sharded), merged by activity
+    parts = router.fan_out(page)
+    merged = sorted((kv for items, _ in parts for kv in items), key=lambda kv: kv[0], reverse=True)
+    if len(merged) > limit or any(more for _, more in parts):
+        merged = merged[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(*merged[-1][0])
+
+    return [item for _, item in merged]
+
+
+def _conversation_items(db: Session, user_id: int, rows):
+    """Sidebar items for (summary, last_read_message_id) rows, with unread counts."""
+    # marks still waiting for the next flush count as read already
+    pending = read_tracker.pending_for(user_id)
+    watermarks = {}
+    for s, last_read in rows:
+        marked = pending.get(s.conversation_id)
+        if marked is not None:
+            marked = min(marked, s.last_message_id or 0)
+            if marked > (last_read or 0):
+                last_read = marked
+        watermarks[s.conversation_id] = last_read
+    unread = unread_counts(db, user_id, watermarks)
 
-    for c in conversations:
-        display_name = None
+    return [
+        ConversationListItem(
+            conversation_id=s.conversation_id,
+            is_group=s.is_group,
+            title=s.title,
+            display_name=summaries.display_name_for(s, user_id),
+            last_message=s.last_message_preview,
+            last_message_at=s.last_message_at,
+            last_read_message_id=watermarks[s.conversation_id],
+            unread_count=unread[s.conversation_id],
+        )
+        for s, _ in rows
+    ]
 
-        if not c.is_group:
-            for cp in c.participants:
-                if cp.user_id != user_id:
-                    user = cp.user or db.query(models.User).get(cp.user_id)
-                    display_name = user.name or user.email
-                    break
-        else:
-            display_name = c.title or f"Group {c.id}"
 
-        last_msg = (
-            db.query(models.Message)
-            .filter(models.Message.conversation_id == c.id)
-            .order_by(desc(models.Message.created_at))
-            .first()
-        )
+@app.post("/conversations/{convo_id}/read", status_code=status.HTTP_202_ACCEPTED)
+async def mark_read(
+    convo_id: int,
+    payload: MarkReadIn,
+    db: AsyncSession = Depends(get_async_convo_db),
+    current_user: dict = Depends(get_current_user),
+):
+    user_id = current_user["user_id"]
 
-        result.append(
-            ConversationListItem(
-                conversation_id=c.id,
-                is_group=c.is_group,
-                title=c.title,
-                display_name=display_name,
-                last_message=last_msg.content if last_msg else None,
-                last_message_at=last_msg.created_at if last_msg else None,
-            )
-        )
+    if not await membership_index.arole_of(db, convo_id, user_id):
+        raise HTTPException(status_code=404)
+    if payload.message_id <= 0:
+        raise HTTPException(status_code=400, detail="message_id must be positive")
 
-    return result
+    # coalesced with other marks and written by the next flush
+    read_tracker.mark(convo_id, user_id, payload.message_id)
+    return {"conversation_id": convo_id, "message_id": payload.message_id}
 
 
 @app.get("/conversations/{convo_id}/messages", response_model=List[MessageOut])
 def get_messages(
     convo_id: int,
-    db: Session = Depends(get_db),
+    response: Response,
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_convo_db),
     current_user: dict = Depends(get_current_user),
 ):
     user_id = current_user["user_id"]
 
-    membership = (
-        db.query(models.ConversationParticipant)
-        .filter_by(conversation_id=convo_id, user_id=user_id)
-        .first()
-    )
-    if not membership:
+    if not membership_index.is_member(db, convo_id, user_id):
         raise HTTPException(status_code=404)
 
-    messages = (
-    db.query(models.Message)
-    .filter(models.Message.conversation_id == convo_id)
-    .order_by(models.Message.created_at)
-    .all()
-)
+    if not before and not after:
+        # newest page: usually served from the in-memory ring buffer
+        cached = recent_messages.first_page(db, convo_id, limit)
+        if cached is not None:
+            messages, next_cursor = cached
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return messages
+
+    messages, next_cursor = history.page_messages(
+        db, convo_id, limit, before=before, after=after
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     return [
         MessageOut(
             id=m.id,
             conversation_id=m.conversation_id,
             sender_id=m.sender_id,
-            sender_name=m.sender.name,   # 👈 ADD THIS
+            sender_name=m.sender.name,
             content=m.content,
             created_at=m.created_at,
             status=m.status,
@@ -274,6 +475,25 @@ def get_messages(
 
 
 
+@app.get("/conversations/{convo_id}/export")
+def export_messages(
+    convo_id: int,
+    db: Session = Depends(get_convo_db),
+    current_user: dict = Depends(get_current_user),
+):
+    # whole history as NDJSON (one MessageOut-shaped object per line), streamed
+    if not membership_index.is_member(db, convo_id, current_user["user_id"]):
+        raise HTTPException(status_code=404)
+
+    return StreamingResponse(
+        history.export_ndjson(router.shard_for(convo_id).ReadSessionLocal, convo_id),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="conversation-{convo_id}.ndjson"'
+        },
+    )
+
+
 @app.post(
     "/conversations/{convo_id}/messages",
     response_model=MessageOut,
@@ -282,57 +502,211 @@ def get_messages(
 async def post_message(
     convo_id: int,
     payload: SendMessageIn,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_convo_db),
     current_user: dict = Depends(get_current_user),
 ):
     user_id = current_user["user_id"]
 
-    membership = (
-        db.query(models.ConversationParticipant)
-        .filter_by(conversation_id=convo_id, user_id=user_id)
-        .first()
-    )
-    if not membership:
+    if not await membership_index.arole_of(db, convo_id, user_id):
         raise HTTPException(status_code=404)
 
-    msg = models.Message(
-        conversation_id=convo_id,
-        sender_id=user_id,
-        content=payload.content,
-        created_at=datetime.utcnow(),
-        status="sent",
-    )
+    if message_writer.enabled:
+        # hand the pooled connection back while we wait for the batch
+        await db.close()
+        out = MessageOut(
+            **await message_writer.submit(convo_id, user_id, payload.content)
+        )
+    else:
+        await db.close()
+        # db is a reader; the insert goes through the one writer connection
+        out = await asyncio.to_thread(_insert_message, convo_id, user_id, payload.content)
 
-    db.add(msg)
-    db.commit()
-    db.refresh(msg)
+    recent_messages.append(out)
 
     await manager.broadcast_to_conversation(
         convo_id,
         {
             "type": "message_created",
             "message": {
-                "id": msg.id,
-                "conversation_id": msg.conversation_id,
-                "sender_id": msg.sender_id,
-                "sender_name": msg.sender.name,
-                "content": msg.content,
-                "created_at": msg.created_at.isoformat(),
-                "status": msg.status,
+                "id": out.id,
+                "conversation_id": out.conversation_id,
+                "sender_id": out.sender_id,
+                "sender_name": out.sender_name,
+                "content": out.content,
+                "created_at": out.created_at.isoformat(),
+                "status": out.status,
             },
         },
     )
 
-    return MessageOut(
-    id=msg.id,
-    conversation_id=msg.conversation_id,
-    sender_id=msg.sender_id,
-    sender_name=msg.sender.name,  
-    content=msg.content,
-    created_at=msg.created_at,
-    status=msg.status,
+    return out
+
+
+
+def _insert_message(convo_id: int, user_id: int, content: str) -> MessageOut:
+    with router.shard_for(convo_id).SessionLocal() as db:
+        msg = models.Message(
+            conversation_id=convo_id,
+            sender_id=user_id,
+            content=content,
+            created_at=datetime.utcnow(),
+            status="sent",
+        )
+
+        db.add(msg)
+        db.flush()
+        summaries.apply_message(db, msg)
+        sender_name = db.scalar(
+            select(models.User.name).filter(models.User.id == user_id)
+        )
+        db.commit()
+
+        return MessageOut(
+            id=msg.id,
+            conversation_id=msg.conversation_id,
+            sender_id=msg.sender_id,
+            sender_name=sender_name,
+            content=msg.content,
+            created_at=msg.created_at,
+            status=msg.status,
+        )
+
+
+# --------------------------------------------------
+# Delta sync
+# --------------------------------------------------
+
+@app.get("/sync", response_model=SyncOut)
+def sync_changes(
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(500, ge=1, le=2000),
+    current_user: dict = Depends(get_current_user),
+):
+    """Everything visible to the caller that changed after `cursor`.
+
+    Without `cursor` nothing is returned except the current head `cursor`:
+    take it before the initial full load, then sync from it after
+    reconnecting. The cursor is opaque to clients (one change-log seq per
+    shard, so a single number without CHAT_SHARDS).
+    """
+    user_id = current_user["user_id"]
+
+    if cursor is None:
+        return SyncOut(
+            cursor=shards.encode_seqs(router.fan_out(changelog.head_seq)),
+            has_more=False,
+            conversations=[],
+            messages=[],
+            members=[],
+        )
+    try:
+        seqs = shards.decode_seqs(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # the limit is shared between shards
+    per_shard = -(-limit // len(seqs))
+    pages = router.fan_out(
+        lambda db: _sync_from(db, user_id, seqs[db.info["shard"]], per_shard)
+    )
+    return SyncOut(
+        cursor=shards.encode_seqs([seq for seq, _ in pages]),
+        has_more=any(p.has_more for _, p in pages),
+        conversations=[c for _, p in pages for c in p.conversations],
+        messages=[m for _, p in pages for m in p.messages],
+        members=[m for _, p in pages for m in p.members],
+    )
+
+
+def _sync_from(db: Session, user_id: int, since: int, limit: int) -> Tuple[int, SyncOut]:
+    """(new seq, page) for one database; the page's cursor is filled in by the caller."""
+    # read before the scan: seqs commit in order, so everything up to head
+    # is visible to it (the two SELECTs aren't one snapshot)
+    head = changelog.head_seq(db)
+    changes, has_more = changelog.changes_since(db, user_id, since, limit)
+
+    message_ids = [c.ref_id for c in changes if c.kind == "message"]
+    member_ids = [c.ref_id for c in changes if c.kind == "member"]
+    convo_ids = {c.conversation_id for c in changes}
+
+    messages = [
+        MessageOut(
+            id=m.id,
+            conversation_id=m.conversation_id,
+            sender_id=m.sender_id,
+            sender_name=sender_name,
+            content=m.content,
+            created_at=m.created_at,
+            status=m.status,
+        )
+        for m, sender_name in changelog.load_messages(db, message_ids)
+    ]
+    members = [
+        MemberChange(conversation_id=p.conversation_id, user_id=p.user_id, role=p.role)
+        for p in changelog.load_members(db, member_ids)
+    ]
+    conversations = _conversation_items(
+        db, user_id, summaries.list_by_ids(db, user_id, convo_ids)
     )
 
+    seq = changes[-1].seq if changes else since
+    if not has_more:
+        # nothing more for this user up to head: skip the other users'
+        # changes too, or an idle cursor never moves and every poll rescans
+        seq = max(seq, head)
+    return seq, SyncOut(
+        cursor="",
+        has_more=has_more,
+        conversations=conversations,
+        messages=messages,
+        members=members,
+    )
+
+
+# --------------------------------------------------
+# Message search
+# --------------------------------------------------
+
+@app.get("/conversations/{convo_id}/search", response_model=List[MessageSearchHit])
+def search_conversation(
+    convo_id: int,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_convo_db),
+    current_user: dict = Depends(get_current_user),
+):
+    user_id = current_user["user_id"]
+
+    if not membership_index.is_member(db, convo_id, user_id):
+        raise HTTPException(status_code=404)
+
+    return search.search_messages(db, user_id, q, limit, offset, convo_id=convo_id)
+
+
+@app.get("/search", response_model=List[MessageSearchHit])
+def search_all(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_current_user),
+):
+    user_id = current_user["user_id"]
+    if not router.enabled:
+        return router.fan_out(
+            lambda db: search.search_messages(db, user_id, q, limit, offset)
+        )[0]
+
+    # bm25 ranks are per shard, so merging them is approximate
+    hits = [
+        hit
+        for part in router.fan_out(
+            lambda db: search.search_messages(db, user_id, q, offset + limit, 0)
+        )
+        for hit in part
+    ]
+    hits.sort(key=lambda h: (h["rank"], -h["id"]))
+    return hits[offset:offset + limit]
 
 
 # --------------------------------------------------
@@ -341,24 +715,23 @@ async def post_message(
 
 @app.get("/users")
 def search_users(
+    response: Response,
     search: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user),
 ):
-    q = db.query(models.User)
-    if search:
-        like = f"%{search.lower()}%"
-        q = q.filter(
-            models.User.name.ilike(like) | models.User.email.ilike(like)
-        )
-    users = q.limit(50).all()
-    return [{"id": u.id, "name": u.name, "email": u.email} for u in users]
+    users, next_cursor = directory.search_users(db, search, limit, cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [{"id": u["id"], "name": u["name"], "email": u["email"]} for u in users]
 
 
 @app.post("/conversations/start", response_model=ConversationListItem)
 def start_conversation(
     payload: Start1to1In,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user),
 ):
     me = current_user["user_id"]
@@ -370,39 +743,51 @@ def start_conversation(
     cp1 = aliased(models.ConversationParticipant)
     cp2 = aliased(models.ConversationParticipant)
 
-    conv = (
-        db.query(models.Conversation)
-        .join(cp1, cp1.conversation_id == models.Conversation.id)
-        .join(cp2, cp2.conversation_id == models.Conversation.id)
-        .filter(models.Conversation.is_group == False)
-        .filter(cp1.user_id == me)
-        .filter(cp2.user_id == other)
-        .first()
-    )
-
-    if not conv:
-        conv = models.Conversation(is_group=False, created_by=me)
-        db.add(conv)
-        db.flush()
-        db.add_all([
-            models.ConversationParticipant(conversation_id=conv.id, user_id=me),
-            models.ConversationParticipant(conversation_id=conv.id, user_id=other),
-        ])
-        db.commit()
-        db.refresh(conv)
-
-    other_user = next(
-        cp.user for cp in conv.participants if cp.user_id != me
-    )
+    def find_dm(db):
+        row = (
+            db.query(models.Conversation.id)
+            .join(cp1, cp1.conversation_id == models.Conversation.id)
+            .join(cp2, cp2.conversation_id == models.Conversation.id)
+            .filter(models.Conversation.is_group == False)
+            .filter(cp1.user_id == me)
+            .filter(cp2.user_id == other)
+            .first()
+        )
+        return row[0] if row else None
+
+    # the DM could be on any shard
+    found = [c for c in router.fan_out(find_dm) if c is not None]
+    convo_id = found[0] if found else router.allocate_conversation_id()
+
+    with router.shard_for(convo_id).SessionLocal() as db:
+        conv = db.get(models.Conversation, convo_id) if found else None
+
+        if not conv:
+            conv = models.Conversation(id=convo_id, is_group=False, created_by=me)
+            db.add(conv)
+            db.flush()
+            db.add_all([
+                models.ConversationParticipant(conversation_id=conv.id, user_id=me),
+                models.ConversationParticipant(conversation_id=conv.id, user_id=other),
+            ])
+            summaries.create_summary(db, conv, [me, other])
+            db.commit()
+            db.refresh(conv)
+            membership_index.add(conv.id, {me: "member", other: "member"}, new=True)
+            background_tasks.add_task(manager.notify_joined, conv.id, [me, other])
+
+        other_user = next(
+            cp.user for cp in conv.participants if cp.user_id != me
+        )
 
-    return ConversationListItem(
-        conversation_id=conv.id,
-        is_group=False,
-        title=None,
-        display_name=other_user.name or other_user.email,
-        last_message=None,
-        last_message_at=None,
-    )
+        return ConversationListItem(
+            conversation_id=conv.id,
+            is_group=False,
+            title=None,
+            display_name=other_user.name or other_user.email,
+            last_message=None,
+            last_message_at=None,
+        )
 
 
 
@@ -410,7 +795,7 @@ def start_conversation(
 @app.post("/conversations/group", response_model=ConversationListItem)
 def create_group(
     payload: CreateGroupIn,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user),
 ):
     me = current_user["user_id"]
@@ -418,28 +803,30 @@ def create_group(
     if not payload.user_ids:
         raise HTTPException(status_code=400, detail="Group must have users")
 
-    conv = models.Conversation(
-        is_group=True,
-        title=payload.title,
-        created_by=me,
-    )
-    db.add(conv)
-    db.flush()
-
-    participants = set(payload.user_ids)
-    participants.add(me)
-
-    for uid in participants:
-        db.add(
-            models.ConversationParticipant(
-                conversation_id=conv.id,
-                user_id=uid,
-                role="admin" if uid == me else "member",
-            )
+    convo_id = router.allocate_conversation_id()
+    with router.shard_for(convo_id).SessionLocal() as db:
+        conv = models.Conversation(
+            id=convo_id,
+            is_group=True,
+            title=payload.title,
+            created_by=me,
         )
+        db.add(conv)
+        db.flush()
 
-    db.commit()
-    db.refresh(conv)
+        members = set(payload.user_ids) - {me}
+        participants.check_users_exist(db, members)
+        participants.add_members(db, conv.id, [me], role="admin")
+        participants.add_members(db, conv.id, members)
+        summaries.create_summary(db, conv, members | {me})
+
+        db.commit()
+        db.refresh(conv)
+
+    roles = {uid: "member" for uid in members}
+    roles[me] = "admin"
+    membership_index.add(conv.id, roles, new=True)
+    background_tasks.add_task(manager.notify_joined, conv.id, list(roles))
 
     return ConversationListItem(
         conversation_id=conv.id,
@@ -454,8 +841,9 @@ def create_group(
 @app.post("/conversations/{convo_id}/add-users")
 def add_users_to_group(
     convo_id: int,
+    background_tasks: BackgroundTasks,
     user_ids: List[int] = Body(...),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_convo_db),
     current_user: dict = Depends(get_current_user),
 ):
     me = current_user["user_id"]
@@ -464,52 +852,33 @@ def add_users_to_group(
     if not conv or not conv.is_group:
         raise HTTPException(status_code=404)
 
-    admin = (
-        db.query(models.ConversationParticipant)
-        .filter_by(
-            conversation_id=convo_id,
-            user_id=me,
-            role="admin",
-        )
-        .first()
-    )
-    if not admin:
+    if membership_index.role_of(db, convo_id, me) != "admin":
         raise HTTPException(status_code=403)
 
-    existing = {
-        cp.user_id for cp in conv.participants
-    }
-
-    for uid in user_ids:
-        if uid not in existing:
-            db.add(
-                models.ConversationParticipant(
-                    conversation_id=convo_id,
-                    user_id=uid,
-                )
-            )
+    # the unique index decides what already exists (the membership index may
+    # be stale if another worker added members)
+    participants.check_users_exist(db, user_ids)
+    added = participants.add_members(db, convo_id, user_ids)
 
     db.commit()
-    return {"status": "ok"}
+    membership_index.add(convo_id, {uid: "member" for uid in added})
+    if added:
+        background_tasks.add_task(manager.notify_joined, convo_id, added)
+    return {"status": "ok", "added": len(added)}
 
 
 @app.get("/conversations/{convo_id}/participants")
 def get_conversation_participants(
     convo_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_convo_db),
     current_user: dict = Depends(get_current_user),
 ):
     user_id = current_user["user_id"]
 
-    membership = (
-        db.query(models.ConversationParticipant)
-        .filter_by(conversation_id=convo_id, user_id=user_id)
-        .first()
-    )
-    if not membership:
+    if not membership_index.is_member(db, convo_id, user_id):
         raise HTTPException(status_code=404)
 
-    participants = (
+    rows = (
         db.query(models.ConversationParticipant)
         .join(models.User)
         .filter(models.ConversationParticipant.conversation_id == convo_id)
@@ -523,7 +892,7 @@ def get_conversation_participants(
             "email": p.user.email,
             "role": p.role,
         }
-        for p in participants
+        for p in rows
     ]
 
 
@@ -0,0 +1,171 @@
+# membership.py
+# Process-local index of conversation membership.
+#
+#   conversation_id -> {user_id: role}
+#
+# Filled lazily from conversation_participants (one query per conversation
+# on first use) and updated write-through by the endpoints that add
+# participants, so authorization checks are dict lookups.
+#
+# Participants are never removed, so a cached "member" answer is always
+# right. A cached "not a member" answer may be stale when another worker
+# added the user, so negatives are re-checked against the database.
+# Conversations with no participants (ids that don't exist) are not cached,
+# and the map is an LRU of at most CHAT_MEMBERSHIP_CACHE_SIZE entries, so
+# probing random ids can't grow the index without bound.
+#
+# A user's conversation list (conversations_of, used once per /ws connect)
+# is not cached: a worker only hears about a join when it already has a
+# socket for that user, so a cached list could silently miss conversations
+# joined through another worker.
+#
+# With sharded storage, per-conversation lookups take a session on the
+# owning shard; a user's conversation list is gathered from every shard.
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from sqlalchemy.orm import Session
+
+import models
+from shards import router
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("CHAT_MEMBERSHIP_CACHE_SIZE", "50000"))
+
+
+class MembershipIndex:
+    def __init__(self, maxsize: int = MEMBERSHIP_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.members: "OrderedDict[int, Dict[int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _store(self, cache: OrderedDict, key: int, value):
+        # caller holds the lock
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+            self.evictions += 1
+
+    # ---- lookups ----
+
+    def peek(self, convo_id: int, user_id: int) -> Optional[str]:
+        """Role if the index already knows the user is a member, else None."""
+        with self._lock:
+            members = self.members.get(convo_id)
+            if members is not None:
+                self.members.move_to_end(convo_id)
+                role = members.get(user_id)
+                if role is not None:
+                    self.hits += 1
+                    return role
+        return None
+
+    def role_of(self, db: Session, convo_id: int, user_id: int) -> Optional[str]:
+        """Role of user_id in convo_id, or None if not a member."""
+        role = self.peek(convo_id, user_id)
+        if role is not None:
+            return role
+
+        if convo_id not in self.members:
+            # a fresh load is authoritative
+            return self._load_conversation(db, convo_id).get(user_id)
+
+        # not in the (possibly stale) cached set: ask the database once
+        row = (
+            db.query(models.ConversationParticipant.role)
+            .filter_by(conversation_id=convo_id, user_id=user_id)
+            .first()
+        )
+        if row is None:
+            return None
+        role = row[0] or "member"
+        self.add(convo_id, {user_id: role})
+        return role
+
+    async def arole_of(self, db, convo_id: int, user_id: int) -> Optional[str]:
+        """role_of for AsyncSession callers; cache hits skip the database."""
+        role = self.peek(convo_id, user_id)
+        if role is not None:
+            return role
+        return await db.run_sync(self.role_of, convo_id, user_id)
+
+    def is_member(self, db: Session, convo_id: int, user_id: int) -> bool:
+        return self.role_of(db, convo_id, user_id) is not None
+
+    def members_of(self, db: Session, convo_id: int) -> Dict[int, str]:
+        with self._lock:
+            members = self.members.get(convo_id)
+            if members is not None:
+                self.members.move_to_end(convo_id)
+                return dict(members)
+        return self._load_conversation(db, convo_id)
+
+    def conversations_of(self, db: Optional[Session], user_id: int) -> Set[int]:
+        """Always read from the database; db is ignored when sharded (every
+        shard is asked, in parallel)."""
+
+        def query(db):
+            return (
+                db.query(models.ConversationParticipant.conversation_id)
+                .filter(models.ConversationParticipant.user_id == user_id)
+                .all()
+            )
+
+        if router.enabled:
+            rows = [row for part in router.fan_out(query) for row in part]
+        else:
+            rows = query(db)
+        return {c for (c,) in rows}
+
+    # ---- loading ----
+
+    def _load_conversation(self, db: Session, convo_id: int) -> Dict[int, str]:
+        rows = (
+            db.query(models.ConversationParticipant.user_id, models.ConversationParticipant.role)
+            .filter(models.ConversationParticipant.conversation_id == convo_id)
+            .all()
+        )
+        with self._lock:
+            self.loads += 1
+            if not rows:
+                # unknown conversation: don't cache, or bogus ids pile up
+                return {}
+            members = self.members.get(convo_id)
+            if members is None:
+                members = {}
+                self._store(self.members, convo_id, members)
+            for uid, role in rows:
+                members[uid] = role or "member"
+            return dict(members)
+
+    # ---- write-through ----
+
+    def add(self, convo_id: int, roles: Dict[int, str], new: bool = False):
+        """Record participants that were just committed.
+
+        new=True means `roles` is the complete member list of a conversation
+        that was just created, so it can be cached without a load.
+        """
+        with self._lock:
+            members = self.members.get(convo_id)
+            if members is not None:
+                members.update(roles)
+            elif new:
+                self._store(self.members, convo_id, dict(roles))
+
+    def stats(self):
+        return {
+            "conversations_cached": len(self.members),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+membership_index = MembershipIndex()
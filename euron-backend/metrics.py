@@ -0,0 +1,361 @@
+# metrics.py
+# Prometheus metrics for GET /metrics (text exposition format 0.0.4).
+#
+# A few hand-rolled counters/gauges/histograms instead of a client library;
+# values are per worker process, so scrape each worker (or sum them on the
+# Prometheus side).
+#
+# What is recorded:
+#
+# * MetricsMiddleware times every HTTP request, labelled with the route
+#   template ("/conversations/{convo_id}/messages"), not the raw path.
+# * track_sql() hooks SQLAlchemy's cursor events on every engine. Statements
+#   run while a request is in flight are also counted against that request,
+#   so a route whose statements-per-request histogram jumps after a change
+#   has grown an N+1. The per-request tally lives in a contextvar, which
+#   follows the request into FastAPI's threadpool and into SQLAlchemy's
+#   async greenlets.
+# * connections.py feeds the WebSocket fan-out and send-failure metrics;
+#   live socket gauges are read from the ConnectionManager at scrape time.
+# * watch_stats() turns a component's stats() dict (password pool, token
+#   cache, read receipts, ...) into chat_<component>_<key> gauges, also
+#   read at scrape time.
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+FANOUT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, k)} {_num(v)}" for k, v in items
+        ]
+
+
+class Gauge(_Metric):
+    """Read at scrape time from a callback returning {label values: value}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect: Optional[Callable] = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        values = self.collect() if self.collect else {}
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, k)} {_num(v)}"
+            for k, v in sorted(values.items())
+        ]
+
+
+class StatsGauges(_Metric):
+    """Every numeric value of a stats() dict as its own gauge.
+
+    stats() is called once per scrape. Nested dicts are flattened
+    ("block_cache": {"hits": 3} -> <prefix>_block_cache_hits), booleans
+    become 0/1 and anything else (None, timestamps) is left out.
+    """
+    kind = "gauge"
+
+    def __init__(self, prefix: str, help: str, stats: Callable[[], dict]):
+        super().__init__(prefix, help)
+        self.stats = stats
+
+    @classmethod
+    def _flatten(cls, prefix: str, values: dict):
+        for key, value in values.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                yield from cls._flatten(name, value)
+            elif isinstance(value, (bool, int, float)):
+                yield name, int(value) if isinstance(value, bool) else value
+
+    def render(self) -> List[str]:
+        lines = []
+        for name, value in self._flatten(self.name, self.stats()):
+            lines += [
+                f"# HELP {name} {self.help}",
+                f"# TYPE {name} {self.kind}",
+                f"{name} {_num(value)}",
+            ]
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values: Dict[Tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self.header()
+        for labels, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = 'le="' + _num(bound) + '"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_num(row[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {row[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ---- HTTP ----
+
+http_requests = registry.add(Counter(
+    "chat_http_requests_total", "HTTP requests by route and status.",
+    ("method", "route", "status"),
+))
+http_latency = registry.add(Histogram(
+    "chat_http_request_duration_seconds", "HTTP request latency.",
+    ("method", "route"),
+))
+
+# ---- SQL ----
+
+sql_statements = registry.add(Counter(
+    "chat_sql_statements_total", "SQL statements executed, in or outside requests.",
+))
+sql_seconds = registry.add(Counter(
+    "chat_sql_seconds_total", "Time spent executing SQL statements.",
+))
+request_sql_statements = registry.add(Histogram(
+    "chat_http_request_sql_statements", "SQL statements per HTTP request.",
+    ("method", "route"), buckets=SQL_COUNT_BUCKETS,
+))
+request_sql_seconds = registry.add(Histogram(
+    "chat_http_request_sql_seconds", "SQL time per HTTP request.",
+    ("method", "route"),
+))
+
+# ---- WebSocket ----
+
+broadcast_fanout = registry.add(Histogram(
+    "chat_ws_broadcast_fanout_seconds",
+    "Time to encode and queue one broadcast for this worker's sockets.",
+    buckets=FANOUT_BUCKETS,
+))
+ws_send_failures = registry.add(Counter(
+    "chat_ws_send_failures_total",
+    "Frames that could not be delivered (queue_overflow, send_timeout, send_failed).",
+    ("reason",),
+))
+ws_evictions = registry.add(Counter(
+    "chat_ws_evictions_total", "Sockets closed by the server, by reason.", ("reason",),
+))
+ws_reaped = registry.add(Counter(
+    "chat_ws_reaped_total",
+    "Sockets removed by the heartbeat sweeper (idle_timeout, stale).",
+    ("reason",),
+))
+
+
+def watch_connections(manager):
+    """Register the live socket gauges of a ConnectionManager."""
+    registry.add(Gauge(
+        "chat_ws_connections", "Open WebSocket connections on this worker.",
+        collect=lambda: {(): manager.connection_count()},
+    ))
+    registry.add(Gauge(
+        "chat_ws_heartbeat_connections",
+        "Open sockets that answer heartbeat pings (and so get idle-reaped).",
+        collect=lambda: {(): manager.heartbeat_count()},
+    ))
+    registry.add(Gauge(
+        "chat_ws_conversation_sockets",
+        "Open sockets subscribed to each conversation on this worker.",
+        ("conversation_id",),
+        collect=lambda: {
+            (convo_id,): len(conns) for convo_id, conns in list(manager.active_connections.items())
+        },
+    ))
+
+
+def watch_stats(component: str, help: str, stats: Callable[[], dict]):
+    """Register a component's stats() as chat_<component>_* gauges."""
+    registry.add(StatsGauges(f"chat_{component}", help, stats))
+
+
+# --------------------------------------------------
+# Per-request SQL accounting
+# --------------------------------------------------
+
+class _RequestSql:
+    # shards.fan_out runs a request's queries on several threads at once
+    __slots__ = ("statements", "seconds", "_lock")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed: float):
+        with self._lock:
+            self.statements += 1
+            self.seconds += elapsed
+
+
+_current_sql: ContextVar[Optional[_RequestSql]] = ContextVar("chat_request_sql", default=None)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("chat_query_start", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish(conn)
+
+
+def _on_error(context):
+    # after_cursor_execute doesn't fire for a failed statement; pop its start
+    # here or the stack on the pooled connection's info grows for good
+    if context.connection is not None and context.statement is not None:
+        _finish(context.connection)
+
+
+def _finish(conn):
+    starts = conn.info.get("chat_query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    sql_statements.inc()
+    sql_seconds.inc(amount=elapsed)
+    tally = _current_sql.get()
+    if tally is not None:
+        tally.add(elapsed)
+
+
+def track_sql():
+    """Time every statement on every engine (sync and the async engines' sync side)."""
+    if not event.contains(Engine, "before_cursor_execute", _before_execute):
+        event.listen(Engine, "before_cursor_execute", _before_execute)
+        event.listen(Engine, "after_cursor_execute", _after_execute)
+        event.listen(Engine, "handle_error", _on_error)
+
+
+# --------------------------------------------------
+# Middleware
+# --------------------------------------------------
+
+class MetricsMiddleware:
+    """Plain ASGI middleware (no BaseHTTPMiddleware buffering) for HTTP requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        tally = _RequestSql()
+        token = _current_sql.set(tally)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_sql.reset(token)
+            route = scope.get("route")
+            # unmatched paths share one label so scanners can't blow up cardinality
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_requests.inc(method, path, str(status))
+            http_latency.observe(elapsed, method, path)
+            request_sql_statements.observe(tally.statements, method, path)
+            request_sql_seconds.observe(tally.seconds, method, path)
@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+    Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 )
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -14,6 +14,12 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     password = Column(String)
 
+    # directory search (directory.py) does prefix range scans on these
+    __table_args__ = (
+        Index("ix_users_name_lower", func.lower(name)),
+        Index("ix_users_email_lower", func.lower(email)),
+    )
+
 
 class Conversation(Base):
     __tablename__ = "conversations" 
@@ -38,11 +44,22 @@ class ConversationParticipant(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     role = Column(String, default="member")  # "admin" for group admins
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
+    # read everything up to and including this message (see receipts.py)
+    last_read_message_id = Column(Integer, nullable=True)
 
     # Relationships
     conversation = relationship("Conversation", back_populates="participants")
     user = relationship("User", backref="conversation_participations")
 
+    __table_args__ = (
+        # "which conversations is this user in" (sidebar, membership checks)
+        Index("ix_participants_user_convo", "user_id", "conversation_id"),
+        # one row per member; bulk adds rely on it with INSERT OR IGNORE
+        Index("uq_participants_convo_user", "conversation_id", "user_id", unique=True),
+        # ids stay unique across shards (see shards.reserve_id_range)
+        {"sqlite_autoincrement": True},
+    )
+
 
 
 class Message(Base):
@@ -59,3 +76,89 @@ class Message(Base):
     # Relationships
     conversation = relationship("Conversation", back_populates="messages")
     sender = relationship("User", backref="messages_sent")
+
+    __table_args__ = (
+        # keyset pagination of a conversation's history
+        Index("ix_messages_convo_created_id", "conversation_id", "created_at", "id"),
+        # unread counts: messages after a read watermark, minus the user's own
+        Index("ix_messages_convo_id_sender", "conversation_id", "id", "sender_id"),
+        # ids stay unique across shards (see shards.reserve_id_range)
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ConversationSummary(Base):
+    """Denormalized per-conversation row for the sidebar.
+
+    Kept up to date in the same transaction as every message insert so that
+    GET /conversations is a single indexed query.
+    """
+    __tablename__ = "conversation_summaries"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    is_group = Column(Boolean, default=False)
+    title = Column(String, nullable=True)
+
+    # display-name inputs for 1:1 chats (the viewer picks "the other one")
+    dm_user_a_id = Column(Integer, nullable=True)
+    dm_user_a_name = Column(String, nullable=True)
+    dm_user_b_id = Column(Integer, nullable=True)
+    dm_user_b_name = Column(String, nullable=True)
+
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(Text, nullable=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    message_count = Column(Integer, default=0, nullable=False)
+    # last message time, or creation time for empty conversations
+    last_activity_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_summaries_activity", "last_activity_at", "conversation_id"),
+    )
+
+
+class Change(Base):
+    """Append-only change log behind GET /sync (see changelog.py).
+
+    Rows are written by triggers on messages, conversations and
+    conversation_participants, so seq order is commit order.
+    """
+    __tablename__ = "changes"
+
+    seq = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, nullable=False)
+    kind = Column(String, nullable=False)  # "conversation", "member", "message"
+    ref_id = Column(Integer, nullable=False)  # id of the row in that table
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_changes_convo_seq", "conversation_id", "seq"),
+        # never hand out a seq again, even after pruning the newest rows
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ArchiveBlock(Base):
+    """Offset index of archived messages (see archive.py).
+
+    Each row points at one compressed block in a conversation's segment
+    file and records the (created_at, id) range of the messages in it.
+    """
+    __tablename__ = "archive_blocks"
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, nullable=False)
+    segment = Column(String, nullable=False)  # file name in the archive directory
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+    crc = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_created_at = Column(DateTime(timezone=True), nullable=False)
+    first_message_id = Column(Integer, nullable=False)
+    last_created_at = Column(DateTime(timezone=True), nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_archive_blocks_convo", "conversation_id", "last_created_at", "last_message_id"),
+    )
@@ -0,0 +1,22 @@
+# pagination.py
+# Opaque keyset cursors: "<iso timestamp>|<id>".
+#
+# Both the conversation list and message history order by (timestamp, id),
+# so one cursor format serves both. The id breaks ties between rows that
+# share a timestamp, which keeps pages stable while new rows arrive.
+from datetime import datetime
+from typing import Tuple
+
+from fastapi import HTTPException
+
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    return f"{ts.isoformat()}|{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        ts, row_id = cursor.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,86 @@
+# participants.py
+# Bulk membership writes for create_group and add-users.
+#
+# Adding N members is two statements however large N is:
+#
+#   1. one set-based check that every id is an existing user;
+#   2. INSERT OR IGNORE ... SELECT over the id list, RETURNING the rows
+#      that were actually inserted.
+#
+# The id list goes in as a single JSON parameter expanded with json_each,
+# so there is no per-id bind variable (and no SQLite variable limit), and
+# duplicates are resolved by the unique (conversation_id, user_id) index
+# rather than by loading the existing members first. The write lock is held
+# for those statements only.
+import json
+from typing import Iterable, List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+
+# how many unknown ids to name in the 400 response
+_MAX_REPORTED = 20
+
+_UNKNOWN_SQL = text(
+    """
+    SELECT DISTINCT ids.value FROM json_each(:ids) AS ids
+    WHERE ids.value NOT IN (SELECT id FROM users)
+    LIMIT :limit
+    """
+)
+
+_INSERT_SQL = text(
+    """
+    INSERT OR IGNORE INTO conversation_participants (conversation_id, user_id, role)
+    SELECT DISTINCT :convo_id, ids.value, :role FROM json_each(:ids) AS ids
+    RETURNING user_id
+    """
+)
+
+# keeps the earliest row of each (conversation_id, user_id) pair
+_DEDUPE_SQL = """
+    DELETE FROM conversation_participants
+    WHERE id NOT IN (
+        SELECT min(id) FROM conversation_participants
+        GROUP BY conversation_id, user_id
+    )
+"""
+
+
+def check_users_exist(db: Session, user_ids: Iterable[int]):
+    """400 if any of user_ids is not a user."""
+    unknown = [
+        uid for (uid,) in db.execute(
+            _UNKNOWN_SQL, {"ids": json.dumps(sorted(set(user_ids))), "limit": _MAX_REPORTED}
+        )
+    ]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown user ids: {unknown}")
+
+
+def add_members(db: Session, convo_id: int, user_ids: Iterable[int], role: str = "member") -> List[int]:
+    """Insert the ones not already in convo_id; returns the user ids added.
+
+    Doesn't commit. Callers validate the ids first (check_users_exist).
+    """
+    ids = sorted(set(user_ids))
+    if not ids:
+        return []
+    rows = db.execute(
+        _INSERT_SQL, {"convo_id": convo_id, "role": role, "ids": json.dumps(ids)}
+    )
+    return [uid for (uid,) in rows]
+
+
+def dedupe_participants(engine):
+    """Drop duplicate member rows so the unique index can be built on old databases."""
+    with engine.begin() as conn:
+        has_index = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uq_participants_convo_user'"
+        ).first()
+        has_table = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_participants'"
+        ).first()
+        if has_table and not has_index:
+            conn.exec_driver_sql(_DEDUPE_SQL)
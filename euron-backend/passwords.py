@@ -0,0 +1,144 @@
+# passwords.py
+# bcrypt hashing/verification on a dedicated, size-limited process pool.
+#
+# A bcrypt round is 100-300 ms of CPU. Run inline, each login holds a
+# threadpool slot *and* the GIL, so a login storm starves every other sync
+# endpoint. Here the work runs in CHAT_PASSWORD_WORKERS child processes and
+# hash()/verify() are coroutines that await the future on the event loop -
+# no threadpool thread is held while bcrypt runs. At most
+# CHAT_PASSWORD_MAX_PENDING operations may be queued or running - beyond
+# that callers get a 503 straight away instead of piling up. With
+# CHAT_PASSWORD_WORKERS=0 the work runs on a thread instead, under the same
+# limit and stats.
+#
+# If a child dies (OOM killer, crash) the executor is broken for good, so
+# it is replaced and the operation retried once; a second failure is a 503.
+#
+# pwd_context is the same passlib CryptContext as before; the children
+# import this module and use it, so changing its config changes both.
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from logs import get_logger, event
+
+log = get_logger("passwords")
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+PASSWORD_WORKERS = int(os.getenv("CHAT_PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_MAX_PENDING = int(os.getenv("CHAT_PASSWORD_MAX_PENDING", "64"))
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(plain: str, hashed: str) -> bool:
+    return pwd_context.verify(plain, hashed)
+
+
+class PasswordPool:
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.restarts = 0
+
+    def _get_executor(self):
+        # created on first use so importing the app starts nothing; spawn
+        # rather than fork, since the server process already runs threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _discard_executor(self, broken: ProcessPoolExecutor):
+        # the next _get_executor() starts a fresh pool
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self.restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def _submit(self, fn, *args):
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return await asyncio.wrap_future(executor.submit(fn, *args))
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                event(log, "password_pool_broken", logging.ERROR, attempt=attempt + 1)
+        raise HTTPException(
+            status_code=503,
+            detail="Password service unavailable, try again",
+        )
+
+    async def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Too many password operations in progress, try again",
+                )
+            self.pending += 1
+
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return await asyncio.to_thread(fn, *args)
+            return await self._submit(fn, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, plain: str, hashed: str) -> bool:
+        return await self._run(_verify, plain, hashed)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+                "avg_latency_ms": (self.total_seconds / self.completed * 1000) if self.completed else 0.0,
+                "max_latency_ms": self.max_seconds * 1000,
+            }
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,231 @@
+# receipts.py
+# Per-participant read watermarks.
+#
+# conversation_participants.last_read_message_id says "this user has read
+# everything up to and including this message id". Clients move it with
+# POST /conversations/{id}/read or a {"type": "read"} WebSocket event;
+# ReadTracker keeps only the highest pending id per (conversation, user) and
+# writes them every CHAT_READ_FLUSH_MS in one transaction, so a client that
+# scrolls through a hundred messages costs one UPDATE, not a hundred.
+#
+# Watermarks only move forward and are clamped to the conversation's last
+# message. After each flush a {"type": "read"} event goes to the
+# conversation so other members can show read receipts.
+import os
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from shards import router
+from logs import get_logger, event
+
+log = get_logger("receipts")
+
+READ_FLUSH_INTERVAL = float(os.getenv("CHAT_READ_FLUSH_MS", "500")) / 1000
+
+_ADVANCE_SQL = text(
+    """
+    WITH target(message_id) AS (
+        SELECT min(:message_id, coalesce(
+            (SELECT last_message_id FROM conversation_summaries
+             WHERE conversation_id = :convo_id),
+            0
+        ))
+    )
+    UPDATE conversation_participants
+    SET last_read_message_id = (SELECT message_id FROM target)
+    WHERE conversation_id = :convo_id
+      AND user_id = :user_id
+      AND coalesce(last_read_message_id, 0) < (SELECT message_id FROM target)
+    RETURNING last_read_message_id
+    """
+)
+
+
+def _watermark_values(watermarks: Dict[int, Optional[int]], params: dict) -> str:
+    # a VALUES list for `WITH wm(conversation_id, last_read)`; fills params
+    values = []
+    for i, (convo_id, last_read) in enumerate(watermarks.items()):
+        values.append(f"(:c{i}, :w{i})")
+        params[f"c{i}"] = convo_id
+        params[f"w{i}"] = last_read or 0
+    return ", ".join(values)
+
+
+def unread_counts(db: Session, user_id: int, watermarks: Dict[int, Optional[int]]) -> Dict[int, int]:
+    """Unread messages per conversation, in one aggregate query.
+
+    `watermarks` maps conversation_id -> last read message id (None = never
+    read). The user's own messages never count as unread. Messages already
+    moved to the archive (archive.py) count too; that takes a second query,
+    only for conversations with archived messages past the watermark.
+    """
+    if not watermarks:
+        return {}
+    params = {"user_id": user_id}
+    values = _watermark_values(watermarks, params)
+
+    sql = f"""
+        WITH wm(conversation_id, last_read) AS (VALUES {values})
+        SELECT wm.conversation_id, COUNT(m.id)
+        FROM wm
+        JOIN messages m
+          ON m.conversation_id = wm.conversation_id AND m.id > wm.last_read
+        WHERE m.sender_id != :user_id
+        GROUP BY wm.conversation_id
+    """
+    counts = dict.fromkeys(watermarks, 0)
+    counts.update(db.execute(text(sql), params).all())
+
+    archived = db.execute(text(f"""
+        WITH wm(conversation_id, last_read) AS (VALUES {values})
+        SELECT wm.conversation_id, wm.last_read
+        FROM wm
+        WHERE EXISTS (
+            SELECT 1 FROM archive_blocks b
+            WHERE b.conversation_id = wm.conversation_id
+              AND b.last_message_id > wm.last_read
+        )
+    """), params).all()
+    if archived:
+        # archive_blocks only has per-block totals; the search index keeps
+        # each archived message's sender, keyed by message id
+        params = {"user_id": user_id}
+        values = _watermark_values(dict(archived), params)
+        sql = f"""
+            WITH wm(conversation_id, last_read) AS (VALUES {values})
+            SELECT wm.conversation_id, COUNT(*)
+            FROM wm
+            JOIN archived_messages_fts a
+              ON a.rowid > wm.last_read AND a.conversation_id = wm.conversation_id
+            WHERE a.sender_id != :user_id
+            GROUP BY wm.conversation_id
+        """
+        for convo_id, n in db.execute(text(sql), params).all():
+            counts[convo_id] += n
+    return counts
+
+
+class ReadTracker:
+    def __init__(self, flush_interval: float = READ_FLUSH_INTERVAL, session_for=None):
+        self.flush_interval = flush_interval
+        # convo_id -> session factory of the database that owns it
+        self.session_for = session_for or (lambda convo_id: router.shard_for(convo_id).SessionLocal)
+        self.pending: Dict[Tuple[int, int], int] = {}
+        # sync endpoints read `pending` from threadpool threads
+        self._lock = threading.Lock()
+        self._publish = None
+        self._task: Optional[asyncio.Task] = None
+        self.marks = 0
+        self.flushes = 0
+        self.written = 0
+
+    async def start(self, publish):
+        """publish(convo_id, payload) is awaited for every watermark that moved."""
+        self._publish = publish
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # don't lose what is still pending
+        await self.flush()
+
+    def mark(self, convo_id: int, user_id: int, message_id: int):
+        """Record that user_id has read convo_id up to message_id (coalesced)."""
+        key = (convo_id, user_id)
+        with self._lock:
+            self.marks += 1
+            if message_id > self.pending.get(key, 0):
+                self.pending[key] = message_id
+
+    def pending_for(self, user_id: int) -> Dict[int, int]:
+        """Not-yet-flushed watermarks of one user, so reads see their own marks."""
+        with self._lock:
+            return {c: m for (c, u), m in self.pending.items() if u == user_id}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as exc:
+                event(log, "read_flush_failed", logging.ERROR, error=repr(exc))
+
+    async def flush(self):
+        with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+        try:
+            moved = await asyncio.to_thread(self._write, batch)
+        except Exception:
+            # put them back unless a newer mark arrived meanwhile
+            with self._lock:
+                for key, message_id in batch.items():
+                    if message_id > self.pending.get(key, 0):
+                        self.pending[key] = message_id
+            raise
+
+        self.flushes += 1
+        self.written += len(moved)
+        if self._publish:
+            for convo_id, user_id, last_read in moved:
+                await self._publish(
+                    convo_id,
+                    {
+                        "type": "read",
+                        "conversation_id": convo_id,
+                        "user_id": user_id,
+                        "last_read_message_id": last_read,
+                    },
+                )
+
+    def _write(self, batch: Dict[Tuple[int, int], int]) -> List[Tuple[int, int, int]]:
+        # one transaction per owning database (just one unless sharded)
+        groups: Dict[object, Dict[Tuple[int, int], int]] = {}
+        for key, message_id in batch.items():
+            groups.setdefault(self.session_for(key[0]), {})[key] = message_id
+        moved = []
+        for session_factory, marks in groups.items():
+            moved.extend(self._write_marks(session_factory, marks))
+        return moved
+
+    def _write_marks(self, session_factory, batch: Dict[Tuple[int, int], int]) -> List[Tuple[int, int, int]]:
+        db = session_factory()
+        try:
+            moved = []
+            for (convo_id, user_id), message_id in batch.items():
+                row = db.execute(
+                    _ADVANCE_SQL,
+                    {"convo_id": convo_id, "user_id": user_id, "message_id": message_id},
+                ).first()
+                if row is not None:
+                    moved.append((convo_id, user_id, row[0]))
+            db.commit()
+            return moved
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "marks": self.marks,
+            "flushes": self.flushes,
+            "written": self.written,
+        }
+
+
+read_tracker = ReadTracker()
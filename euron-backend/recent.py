@@ -0,0 +1,211 @@
+# recent.py
+# In-memory ring buffer of the newest messages per conversation.
+#
+# Opening a chat reads the newest page of its history, so that page is
+# served from here: the last CHAT_RECENT_MESSAGES messages of each hot
+# conversation, already converted to MessageOut. post_message appends to the
+# buffer of conversations that are cached; cold conversations are evicted
+# least-recently-used first once the estimated size passes
+# CHAT_RECENT_CACHE_MB.
+#
+# Other workers (and the group-commit writer) insert messages this process
+# never sees, so every hit first compares the buffer's newest id with
+# conversation_summaries.last_message_id - one primary-key lookup instead of
+# the page query - and pulls in just the missing messages if they differ.
+import os
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Optional
+
+from sqlalchemy.orm import Session, joinedload
+
+import models
+import history
+from pagination import encode_cursor
+from schemas import MessageOut
+
+RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", "200"))
+RECENT_CACHE_BYTES = int(float(os.getenv("CHAT_RECENT_CACHE_MB", "64")) * 1024 * 1024)
+
+# rough per-message cost on top of the content itself (model, dict, strings)
+_MESSAGE_OVERHEAD = 600
+
+
+def _out(m: models.Message) -> MessageOut:
+    return MessageOut(
+        id=m.id,
+        conversation_id=m.conversation_id,
+        sender_id=m.sender_id,
+        sender_name=m.sender.name if m.sender else None,
+        content=m.content,
+        created_at=m.created_at,
+        status=m.status,
+    )
+
+
+def _size(msg: MessageOut) -> int:
+    return _MESSAGE_OVERHEAD + sys.getsizeof(msg.content) + sys.getsizeof(msg.sender_name or "")
+
+
+class _Buffer:
+    __slots__ = ("messages", "older", "nbytes")
+
+    def __init__(self, capacity: int):
+        self.messages: Deque[MessageOut] = deque(maxlen=capacity)
+        self.older = False  # messages exist before messages[0]
+        self.nbytes = 0
+
+    @property
+    def last_id(self) -> int:
+        return self.messages[-1].id if self.messages else 0
+
+    def append(self, msg: MessageOut):
+        if len(self.messages) == self.messages.maxlen:
+            self.nbytes -= _size(self.messages[0])
+            self.older = True
+        self.messages.append(msg)
+        self.nbytes += _size(msg)
+
+
+class RecentMessages:
+    def __init__(self, capacity: int = RECENT_MESSAGES, max_bytes: int = RECENT_CACHE_BYTES):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._buffers: "OrderedDict[int, _Buffer]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.refreshes = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def first_page(self, db: Session, convo_id: int, limit: int):
+        """(messages oldest-first, next_cursor) like history.page_messages with
+        no cursor, or None if `limit` is larger than the buffer."""
+        if limit > self.capacity or self.capacity <= 0:
+            return None
+
+        latest = (
+            db.query(models.ConversationSummary.last_message_id)
+            .filter(models.ConversationSummary.conversation_id == convo_id)
+            .scalar()
+        ) or 0
+
+        with self._lock:
+            buf = self._buffers.get(convo_id)
+            if buf is not None:
+                self._buffers.move_to_end(convo_id)
+            cached_last = buf.last_id if buf is not None else None
+
+        if buf is None:
+            self.misses += 1
+            buf = self._load(db, convo_id)
+        elif cached_last != latest:
+            self.refreshes += 1
+            buf = self._catch_up(db, convo_id, cached_last) or self._load(db, convo_id)
+        else:
+            self.hits += 1
+
+        with self._lock:
+            messages = list(buf.messages)
+            older = buf.older
+
+        page = messages[-limit:]
+        next_cursor = None
+        if len(messages) > limit or older:
+            if page:
+                next_cursor = encode_cursor(page[0].created_at, page[0].id)
+        return page, next_cursor
+
+    def append(self, msg: MessageOut):
+        """A message was just committed; add it if its conversation is cached."""
+        with self._lock:
+            buf = self._buffers.get(msg.conversation_id)
+            if buf is None or msg.id <= buf.last_id:
+                return
+            tail = buf.messages[-1] if buf.messages else None
+            if tail is not None and (msg.created_at, msg.id) < (tail.created_at, tail.id):
+                # committed out of timestamp order; let the next read reload
+                self._drop(msg.conversation_id)
+                return
+            before = buf.nbytes
+            buf.append(msg)
+            self.nbytes += buf.nbytes - before
+            self._evict()
+
+    # ---- loading ----
+
+    def _load(self, db: Session, convo_id: int) -> _Buffer:
+        rows, next_cursor = history.page_messages(db, convo_id, self.capacity)
+        buf = _Buffer(self.capacity)
+        for m in rows:
+            buf.append(_out(m))
+        buf.older = next_cursor is not None
+        self._install(convo_id, buf)
+        return buf
+
+    def _catch_up(self, db: Session, convo_id: int, after_id: int) -> Optional[_Buffer]:
+        """Append messages newer than after_id; None if a full reload is needed."""
+        M = models.Message
+        rows = (
+            db.query(M)
+            .options(joinedload(M.sender))
+            .filter(M.conversation_id == convo_id, M.id > after_id)
+            .order_by(M.created_at, M.id)
+            .limit(self.capacity + 1)
+            .all()
+        )
+        if len(rows) > self.capacity:
+            return None
+        with self._lock:
+            buf = self._buffers.get(convo_id)
+            if buf is None:
+                return None
+            tail = buf.messages[-1] if buf.messages else None
+            if rows and tail is not None and (rows[0].created_at, rows[0].id) < (tail.created_at, tail.id):
+                return None
+            before = buf.nbytes
+            for m in rows:
+                if m.id > buf.last_id:
+                    buf.append(_out(m))
+            self.nbytes += buf.nbytes - before
+            self._evict()
+            return buf
+
+    def _install(self, convo_id: int, buf: _Buffer):
+        with self._lock:
+            self._drop(convo_id)
+            self._buffers[convo_id] = buf
+            self.nbytes += buf.nbytes
+            self._evict()
+
+    # ---- eviction (call with the lock held) ----
+
+    def _drop(self, convo_id: int):
+        old = self._buffers.pop(convo_id, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._buffers) > 1:
+            convo_id, _ = next(iter(self._buffers.items()))
+            self._drop(convo_id)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.refreshes + self.misses
+        return {
+            "conversations": len(self._buffers),
+            "capacity_per_conversation": self.capacity,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.refreshes) / lookups if lookups else 0.0,
+        }
+
+
+recent_messages = RecentMessages()
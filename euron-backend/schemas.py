@@ -26,6 +26,8 @@ class ConversationListItem(BaseModel):
     display_name: Optional[str]
     last_message: Optional[str]
     last_message_at: Optional[datetime]
+    last_read_message_id: Optional[int] = None
+    unread_count: int = 0
     class Config:
         orm_mode = True
 
@@ -40,9 +42,28 @@ class MessageOut(BaseModel):
     class Config:
         orm_mode = True
 
+class MessageSearchHit(MessageOut):
+    snippet: Optional[str]
+    rank: float
+
+class MemberChange(BaseModel):
+    conversation_id: int
+    user_id: int
+    role: Optional[str]
+
+class SyncOut(BaseModel):
+    cursor: str              # opaque position: pass back as ?cursor= next time
+    has_more: bool           # more changes after `cursor`; call again right away
+    conversations: List[ConversationListItem]
+    messages: List[MessageOut]
+    members: List[MemberChange]
+
 class SendMessageIn(BaseModel):
     content: str
 
+class MarkReadIn(BaseModel):
+    message_id: int
+
 class Start1to1In(BaseModel):
     other_user_id: int
 
@@ -0,0 +1,187 @@
+# search.py
+# Full-text message search on an SQLite FTS5 index.
+#
+# messages_fts is an external-content FTS5 table over messages.content.
+# Triggers on messages keep it in step inside the same transaction as the
+# insert (or delete/update), so every write path - post_message, the
+# group-commit writer, scripts - is covered without calling in here.
+#
+# Messages moved to the archive (archive.py) leave the messages table, and
+# the delete trigger takes them out of messages_fts. archive.py indexes them
+# in archived_messages_fts in the same transaction instead: a plain FTS5
+# table that keeps the text and what a hit needs (conversation, sender,
+# time, status), since there is no live row left to join. Only search reads
+# it, so the hot tables stay small. search_messages queries both.
+#
+# Rebuild both indexes for an existing users.db (every shard's database with
+# CHAT_SHARDS set) with:
+#
+#   python search.py rebuild
+import sys
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS archived_messages_fts USING fts5(
+        content,
+        conversation_id UNINDEXED,
+        sender_id UNINDEXED,
+        created_at UNINDEXED,
+        status UNINDEXED,
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+]
+
+
+def ensure_fts(engine):
+    """Create the FTS table and triggers; index existing rows the first time."""
+    with engine.begin() as conn:
+        existed = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+        ).first()
+        for ddl in FTS_DDL:
+            conn.execute(text(ddl))
+        if not existed:
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+
+def rebuild(engine):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')"))
+
+
+def index_archived(db: Session, convo_id: int, rows):
+    """Index archived (id, sender_id, content, created_at, status) rows."""
+    db.execute(
+        text(
+            "INSERT INTO archived_messages_fts"
+            " (rowid, content, conversation_id, sender_id, created_at, status)"
+            " VALUES (:id, :content, :convo_id, :sender_id, :created_at, :status)"
+        ),
+        [
+            {
+                "id": msg_id,
+                "content": content,
+                "convo_id": convo_id,
+                "sender_id": sender_id,
+                # the same text format SQLAlchemy stores in messages.created_at
+                "created_at": created_at.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                "status": status,
+            }
+            for msg_id, sender_id, content, created_at, status in rows
+        ],
+    )
+
+
+def to_match_query(q: str) -> Optional[str]:
+    """Turn free text into a safe FTS5 query.
+
+    Every word is quoted (so FTS operators in user input are literal) and
+    all words must match; the last word also matches as a prefix, for
+    search-as-you-type.
+    """
+    terms = [t.replace('"', '""') for t in q.split()]
+    terms = [t for t in terms if t]
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_messages(
+    db: Session,
+    user_id: int,
+    q: str,
+    limit: int,
+    offset: int = 0,
+    convo_id: Optional[int] = None,
+):
+    """Ranked hits (best first) in conversations the user belongs to, archived ones included."""
+    match = to_match_query(q)
+    if match is None:
+        return []
+
+    live = """
+        SELECT m.id, m.conversation_id, m.sender_id, u.name AS sender_name,
+               m.content, m.created_at, m.status,
+               snippet(messages_fts, 0, '[', ']', '...', 12) AS snippet,
+               bm25(messages_fts) AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        LEFT JOIN users u ON u.id = m.sender_id
+        WHERE messages_fts MATCH :match
+          AND m.conversation_id IN (
+              SELECT conversation_id FROM conversation_participants
+              WHERE user_id = :user_id
+          )
+    """
+    archived = """
+        SELECT a.rowid AS id, a.conversation_id, a.sender_id, u.name AS sender_name,
+               a.content, a.created_at, a.status,
+               snippet(archived_messages_fts, 0, '[', ']', '...', 12) AS snippet,
+               bm25(archived_messages_fts) AS rank
+        FROM archived_messages_fts AS a
+        LEFT JOIN users u ON u.id = a.sender_id
+        WHERE archived_messages_fts MATCH :match
+          AND a.conversation_id IN (
+              SELECT conversation_id FROM conversation_participants
+              WHERE user_id = :user_id
+          )
+    """
+    params = {"match": match, "user_id": user_id, "limit": limit, "offset": offset}
+    if convo_id is not None:
+        live += " AND m.conversation_id = :convo_id"
+        archived += " AND a.conversation_id = :convo_id"
+        params["convo_id"] = convo_id
+    sql = f"{live} UNION ALL {archived} ORDER BY rank, id DESC LIMIT :limit OFFSET :offset"
+
+    return db.execute(text(sql), params).mappings().all()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python search.py rebuild")
+        sys.exit(2)
+    import archive
+    from shards import router
+    for shard in router.shards:
+        ensure_fts(shard.engine)
+        rebuild(shard.engine)
+        with shard.SessionLocal() as db:
+            archived = archive.rebuild_search_index(db)
+        with shard.engine.connect() as conn:
+            n = conn.execute(text("SELECT COUNT(*) FROM messages")).scalar()
+        print(f"{shard.path}: messages_fts rebuilt over {n} messages, "
+              f"archived_messages_fts over {archived} archived messages")
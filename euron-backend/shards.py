@@ -0,0 +1,261 @@
+# shards.py
+# Optional horizontal sharding of conversations across SQLite files.
+#
+# With CHAT_SHARDS=N (N > 1), everything that belongs to a conversation -
+# conversations, participants, messages, summaries, the change log and the
+# search index - lives in one of N shard files, picked by
+# conversation_id % N. Users (and users_fts) stay in the directory database,
+# CHAT_DATABASE_PATH. Each shard has its own write lock, so message writes
+# to different shards no longer queue behind each other.
+#
+# Shard connections ATTACH the directory database. SQLite resolves an
+# unqualified table name through attached schemas when the shard itself
+# has no such table, so the queries that join `users` for sender names work
+# unchanged on a shard session.
+#
+# Conversation ids must be known before the shard is, so in sharded mode
+# they are allocated from a small `conversation_ids` table in the directory
+# database and inserted explicitly. Message and participant ids must be
+# unique across shards too (clients key on them; /search and /sync merge
+# them): both tables are AUTOINCREMENT and shard n hands out ids from
+# (n + 1) * 2**40 up, so the ranges never meet - see reserve_id_range.
+#
+# ShardRouter is what the session layer uses: shard_for(convo_id) for the
+# owning shard's session factories, fan_out(fn) to run fn(session) on every
+# shard in parallel and collect the results. Without CHAT_SHARDS the router
+# has a single shard wrapping database.py's engines, so the same code paths
+# run against users.db as before.
+#
+#   CHAT_SHARDS        number of shard files (default 0 = not sharded)
+#   CHAT_SHARD_PATH    path template, default "<database path>.shard{n}.db"
+#
+# `python shards.py split` copies an existing unsharded users.db into the
+# shard files (run it once, before starting the app with CHAT_SHARDS).
+import os
+import sys
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import database
+import models  # noqa: F401  (registers the tables on Base.metadata)
+from database import Base, build_engines, build_async_engine
+
+SHARD_COUNT = int(os.getenv("CHAT_SHARDS", "0"))
+_root, _ext = os.path.splitext(database.DATABASE_PATH)
+SHARD_PATH = os.getenv("CHAT_SHARD_PATH", _root + ".shard{n}" + (_ext or ".db"))
+
+# tables that stay in the directory database only
+DIRECTORY_TABLES = {"users"}
+
+# per-shard id ranges for rows clients see by id
+ID_RANGE = 1 << 40
+GLOBAL_ID_TABLES = ("messages", "conversation_participants")
+
+
+def shard_tables():
+    return [t for t in Base.metadata.sorted_tables if t.name not in DIRECTORY_TABLES]
+
+
+def _attach_directory(engine, directory_path: str):
+    @event.listens_for(engine, "connect")
+    def _attach(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS directory", (directory_path,))
+        cursor.close()
+
+
+class Shard:
+    def __init__(self, index: int, path: str, engine, read_engine, async_read_engine):
+        self.index = index
+        self.path = path
+        self.engine = engine
+        self.read_engine = read_engine
+        self.async_read_engine = async_read_engine
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        self.ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+        self.AsyncReadSessionLocal = async_sessionmaker(
+            async_read_engine, autoflush=False, expire_on_commit=False
+        )
+
+    @classmethod
+    def open(cls, index: int, path: str, directory_path: str):
+        engines = build_engines(path) + (build_async_engine(path),)
+        seen = set()
+        for e in engines:
+            sync = getattr(e, "sync_engine", e)
+            if id(sync) not in seen:
+                seen.add(id(sync))
+                _attach_directory(sync, directory_path)
+        return cls(index, path, *engines)
+
+
+class ShardRouter:
+    def __init__(self, count: int = SHARD_COUNT, path_template: str = SHARD_PATH):
+        self.enabled = count > 1
+        if self.enabled:
+            directory_path = os.path.abspath(database.DATABASE_PATH)
+            self.shards = [
+                Shard.open(i, path_template.format(n=i), directory_path) for i in range(count)
+            ]
+            self._pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix="shard")
+        else:
+            # the plain users.db, as a single shard
+            self.shards = [
+                Shard(
+                    0, database.DATABASE_PATH,
+                    database.engine, database.read_engine,
+                    database.async_read_engine,
+                )
+            ]
+            self._pool = None
+
+    def shard_for(self, convo_id: Optional[int]) -> Shard:
+        if not self.enabled:
+            return self.shards[0]
+        if convo_id is None:
+            raise ValueError("sharded mode needs the conversation id up front")
+        return self.shards[convo_id % len(self.shards)]
+
+    def fan_out(self, fn: Callable, write: bool = False) -> List:
+        """[fn(session) for each shard], run in parallel on read (or write) sessions.
+
+        Results are in shard order; db.info["shard"] is the shard's index.
+        Each call runs in a copy of the caller's context, so per-request
+        state (metrics' SQL tally) still sees the statements.
+        """
+
+        def run(shard: Shard):
+            db = (shard.SessionLocal if write else shard.ReadSessionLocal)()
+            db.info["shard"] = shard.index
+            try:
+                return fn(db)
+            finally:
+                db.close()
+
+        if not self.enabled:
+            return [run(self.shards[0])]
+        # a Context can only be entered by one thread at a time: one copy each
+        futures = [
+            self._pool.submit(contextvars.copy_context().run, run, shard)
+            for shard in self.shards
+        ]
+        return [f.result() for f in futures]
+
+    def allocate_conversation_id(self) -> Optional[int]:
+        """A new conversation id in sharded mode; None (autoincrement) otherwise."""
+        if not self.enabled:
+            return None
+        with database.engine.begin() as conn:
+            return conn.execute(
+                text("INSERT INTO conversation_ids DEFAULT VALUES RETURNING id")
+            ).scalar()
+
+    def ensure_directory(self):
+        if not self.enabled:
+            return
+        with database.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS conversation_ids ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " created_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+            ))
+
+    async def dispose(self):
+        if not self.enabled:
+            return
+        for shard in self.shards:
+            await shard.async_read_engine.dispose()
+            shard.engine.dispose()
+            if shard.read_engine is not shard.engine:
+                shard.read_engine.dispose()
+        self._pool.shutdown(wait=False)
+
+
+router = ShardRouter()
+
+
+# Each shard has its own change log, so a sharded /sync position is one seq
+# per shard: "12.0.40" for three shards.
+
+def encode_seqs(seqs: List[int]) -> str:
+    return ".".join(str(s) for s in seqs)
+
+
+def decode_seqs(cursor: str) -> List[int]:
+    seqs = [int(s) for s in cursor.split(".")]
+    if len(seqs) != len(router.shards) or min(seqs) < 0:
+        raise ValueError(cursor)
+    return seqs
+
+
+def reserve_id_range(shard: Shard):
+    """Make the shard's new message/participant ids start in its own range."""
+    base = (shard.index + 1) * ID_RANGE
+    with shard.engine.begin() as conn:
+        for name in GLOBAL_ID_TABLES:
+            ddl = conn.execute(
+                text("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = :n"),
+                {"n": name},
+            ).scalar()
+            if "AUTOINCREMENT" not in (ddl or "").upper():
+                raise RuntimeError(
+                    f"{shard.path}: {name} has no per-shard id range; delete the shard"
+                    " files and re-run `python shards.py split`"
+                )
+            seq = conn.execute(
+                text("SELECT seq FROM main.sqlite_sequence WHERE name = :n"), {"n": name}
+            ).scalar()
+            if seq is None:
+                conn.execute(
+                    text("INSERT INTO main.sqlite_sequence (name, seq) VALUES (:n, :base)"),
+                    {"n": name, "base": base},
+                )
+            elif seq < base:
+                conn.execute(
+                    text("UPDATE main.sqlite_sequence SET seq = :base WHERE name = :n"),
+                    {"n": name, "base": base},
+                )
+
+
+def split():
+    """Copy conversation data from the unsharded users.db into the shards."""
+    if not router.enabled:
+        print("set CHAT_SHARDS to the number of shards first")
+        sys.exit(2)
+    router.ensure_directory()
+    n = len(router.shards)
+    names = [t.name for t in shard_tables()]
+    with database.engine.connect() as src:
+        top = src.execute(text("SELECT coalesce(max(id), 0) FROM conversations")).scalar()
+
+    for shard in router.shards:
+        Base.metadata.create_all(bind=shard.engine, tables=shard_tables())
+        with shard.engine.begin() as conn:
+            for name in names:
+                if name == "changes":
+                    continue  # rebuilt per shard by ensure_changelog
+                key = "id" if name == "conversations" else "conversation_id"
+                conn.execute(text(
+                    f"INSERT OR IGNORE INTO main.{name} SELECT * FROM directory.{name}"
+                    f" WHERE {key} % :n = :i"
+                ), {"n": n, "i": shard.index})
+        reserve_id_range(shard)
+        print(f"shard {shard.index}: {shard.path}")
+
+    # new conversations must get ids above the copied ones
+    with database.engine.begin() as conn:
+        if not conn.execute(text("SELECT 1 FROM conversation_ids LIMIT 1")).first():
+            conn.execute(text("INSERT INTO conversation_ids (id) VALUES (:id)"), {"id": top})
+    print(f"copied conversations up to id {top} into {n} shards; start the app to index them")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["split"]:
+        print("usage: CHAT_SHARDS=N python shards.py split")
+        sys.exit(2)
+    split()
@@ -0,0 +1,199 @@
+# summaries.py
+# Materialized conversation summaries (see models.ConversationSummary).
+#
+# Every write path that changes what the sidebar shows calls in here inside
+# its own transaction, so the summary never drifts from the messages table.
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session
+
+import models
+from pagination import encode_cursor, decode_cursor
+
+PREVIEW_CHARS = 200
+
+
+def _display(user: Optional[models.User]):
+    if not user:
+        return None
+    return user.name or user.email
+
+
+def preview(content: str):
+    if content is None:
+        return None
+    return content[:PREVIEW_CHARS]
+
+
+def create_summary(db: Session, conv: models.Conversation, user_ids=()):
+    """Add the summary row for a freshly flushed conversation."""
+    summary = models.ConversationSummary(
+        conversation_id=conv.id,
+        is_group=bool(conv.is_group),
+        title=conv.title,
+        message_count=0,
+        last_activity_at=datetime.utcnow(),
+    )
+    if not conv.is_group:
+        ids = sorted(user_ids)[:2]
+        users = {
+            u.id: u
+            for u in db.query(models.User).filter(models.User.id.in_(ids))
+        }
+        if ids:
+            summary.dm_user_a_id = ids[0]
+            summary.dm_user_a_name = _display(users.get(ids[0]))
+        if len(ids) > 1:
+            summary.dm_user_b_id = ids[1]
+            summary.dm_user_b_name = _display(users.get(ids[1]))
+    db.add(summary)
+    return summary
+
+
+def apply_message(db: Session, msg: models.Message, count: int = 1):
+    """Fold a flushed (not yet committed) message into its summary.
+
+    `count` lets a batch fold several messages of one conversation in a
+    single UPDATE, with `msg` being the newest of them.
+    """
+    db.query(models.ConversationSummary).filter(
+        models.ConversationSummary.conversation_id == msg.conversation_id
+    ).update(
+        {
+            models.ConversationSummary.last_message_id: msg.id,
+            models.ConversationSummary.last_message_preview: preview(msg.content),
+            models.ConversationSummary.last_message_at: msg.created_at,
+            models.ConversationSummary.last_activity_at: msg.created_at,
+            models.ConversationSummary.message_count:
+                models.ConversationSummary.message_count + count,
+        },
+        synchronize_session=False,
+    )
+
+
+def apply_messages(db: Session, msgs):
+    """Batch version of apply_message: one UPDATE per conversation."""
+    latest = {}
+    counts = {}
+    for m in msgs:
+        counts[m.conversation_id] = counts.get(m.conversation_id, 0) + 1
+        current = latest.get(m.conversation_id)
+        if current is None or (m.created_at, m.id) >= (current.created_at, current.id):
+            latest[m.conversation_id] = m
+    for convo_id, m in latest.items():
+        apply_message(db, m, counts[convo_id])
+
+
+def rebuild_summary(db: Session, convo_id: int):
+    """Recompute one summary from scratch (backfill / repair)."""
+    conv = db.query(models.Conversation).get(convo_id)
+    if not conv:
+        return None
+
+    db.query(models.ConversationSummary).filter_by(conversation_id=convo_id).delete()
+    user_ids = [
+        uid for (uid,) in db.query(models.ConversationParticipant.user_id)
+        .filter(models.ConversationParticipant.conversation_id == convo_id)
+    ]
+    summary = create_summary(db, conv, user_ids)
+    summary.last_activity_at = conv.created_at or summary.last_activity_at
+
+    count = (
+        db.query(func.count(models.Message.id))
+        .filter(models.Message.conversation_id == convo_id)
+        .scalar()
+    )
+    last = (
+        db.query(models.Message)
+        .filter(models.Message.conversation_id == convo_id)
+        .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+        .first()
+    )
+    summary.message_count = count or 0
+    if last:
+        summary.last_message_id = last.id
+        summary.last_message_preview = preview(last.content)
+        summary.last_message_at = last.created_at
+        summary.last_activity_at = last.created_at
+    return summary
+
+
+def backfill_missing(db: Session):
+    """Create summaries for conversations that predate the summary table."""
+    missing = (
+        db.query(models.Conversation.id)
+        .outerjoin(
+            models.ConversationSummary,
+            models.ConversationSummary.conversation_id == models.Conversation.id,
+        )
+        .filter(models.ConversationSummary.conversation_id.is_(None))
+        .all()
+    )
+    for (convo_id,) in missing:
+        rebuild_summary(db, convo_id)
+    if missing:
+        db.commit()
+    return len(missing)
+
+
+# --------------------------------------------------
+# Listing
+# --------------------------------------------------
+
+def display_name_for(summary: models.ConversationSummary, user_id: int):
+    if summary.is_group:
+        return summary.title or f"Group {summary.conversation_id}"
+    if summary.dm_user_a_id == user_id:
+        return summary.dm_user_b_name
+    return summary.dm_user_a_name
+
+
+def list_for_user(db: Session, user_id: int, limit: int, cursor: Optional[str] = None):
+    """One query: the user's conversations ordered by last activity.
+
+    Returns (rows, next_cursor); each row is (summary, last_read_message_id).
+    """
+    S = models.ConversationSummary
+    P = models.ConversationParticipant
+    q = (
+        db.query(S, P.last_read_message_id)
+        .join(P, P.conversation_id == S.conversation_id)
+        .filter(P.user_id == user_id)
+    )
+    if cursor:
+        ts, convo_id = decode_cursor(cursor)
+        q = q.filter(
+            or_(
+                S.last_activity_at < ts,
+                and_(S.last_activity_at == ts, S.conversation_id < convo_id),
+            )
+        )
+
+    rows = (
+        q.order_by(S.last_activity_at.desc(), S.conversation_id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_cursor(last.last_activity_at, last.conversation_id)
+    return rows, next_cursor
+
+
+def list_by_ids(db: Session, user_id: int, convo_ids):
+    """Same rows as list_for_user, for specific conversations of the user."""
+    if not convo_ids:
+        return []
+    S = models.ConversationSummary
+    P = models.ConversationParticipant
+    return (
+        db.query(S, P.last_read_message_id)
+        .join(P, P.conversation_id == S.conversation_id)
+        .filter(P.user_id == user_id, S.conversation_id.in_(convo_ids))
+        .order_by(S.last_activity_at.desc(), S.conversation_id.desc())
+        .all()
+    )
@@ -0,0 +1,69 @@
+# test_directory.py
+# Tier queries of directory.search_users against a scratch in-memory
+# database.  Run with `python -m pytest` from euron-backend.
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import models
+import directory
+
+USERS = [
+    {"id": 1, "name": "Alice Smith", "email": "alice@example.com"},
+    {"id": 2, "name": "Bob", "email": "smithy@example.com"},
+    {"id": 3, "name": None, "email": "nameless@example.com"},
+    {"id": 4, "name": None, "email": "carol.smith@example.com"},
+    {"id": 5, "name": "Dave_1", "email": "dave1@x.org"},
+]
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(bind=engine, tables=[models.User.__table__])
+    directory.ensure_users_fts(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO users (id, name, email, password) VALUES (:id, :name, :email, 'x')"),
+            USERS,
+        )
+    with sessionmaker(bind=engine)() as session:
+        yield session
+    engine.dispose()
+
+
+def ids(db, q, limit=10, cursor=None):
+    rows, next_cursor = directory.search_users(db, q, limit, cursor)
+    return [r["id"] for r in rows], next_cursor
+
+
+@pytest.mark.parametrize("q, expected", [
+    ("alice", [1]),          # name prefix
+    ("smith", [2, 1, 4]),    # email prefix, then substring (incl. no name)
+    ("nameless", [3]),       # email prefix, no name
+    ("carol", [4]),          # email prefix, no name
+    ("ameles", [3]),         # trigram substring, no name
+    ("@x", [5]),             # too short for trigrams: LIKE scan
+    ("1@", [5]),
+    ("e_", [5]),             # _ is literal, not a LIKE wildcard
+    ("%", []),
+])
+def test_tiers(db, q, expected):
+    assert ids(db, q)[0] == expected
+
+
+def test_empty_query_lists_everyone_once(db):
+    found, _ = ids(db, "")
+    assert sorted(found) == [u["id"] for u in USERS]
+
+
+@pytest.mark.parametrize("q", ["smith", "@x", "a"])
+def test_paging_across_tiers(db, q):
+    everything, _ = ids(db, q, limit=100)
+    seen, cursor = [], None
+    while True:
+        page, cursor = ids(db, q, limit=1, cursor=cursor)
+        seen.extend(page)
+        if not cursor:
+            break
+    assert seen == everything
@@ -1,52 +1,110 @@
-from fastapi import HTTPException, Depends
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+import asyncio
+
+from fastapi import HTTPException, Request
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas import UserSignup
 
 import models
-from database import SessionLocal
+from passwords import password_pool
+from logs import get_logger, event
+from database import (
+    SessionLocal,
+    ReadSessionLocal,
+    AsyncReadSessionLocal,
+    READ_METHODS,
+)
+from shards import router
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+log = get_logger("auth")
 
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    # GET requests read from the reader pool, everything else gets the writer
+    if request.method in READ_METHODS:
+        db = ReadSessionLocal()
+    else:
+        db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
 
-def verify_password(plain, hashed):
-    return pwd_context.verify(plain, hashed)
+async def get_async_read_db():
+    # for async def endpoints only, and only to read (see database.py);
+    # writes go through SessionLocal in a thread
+    async with AsyncReadSessionLocal() as db:
+        yield db
 
 
+def get_convo_db(convo_id: int, request: Request):
+    # like get_db, on the database that owns convo_id (see shards.py)
+    shard = router.shard_for(convo_id)
+    if request.method in READ_METHODS:
+        db = shard.ReadSessionLocal()
+    else:
+        db = shard.SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_convo_db(convo_id: int):
+    # like get_async_read_db, on the database that owns convo_id
+    async with router.shard_for(convo_id).AsyncReadSessionLocal() as db:
+        yield db
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = db.query(models.User).filter(models.User.email == email).first()
+
+async def verify_password(plain, hashed):
+    return await password_pool.verify(plain, hashed)
+
+
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = (
+        await db.execute(
+            select(models.User.id, models.User.password).where(models.User.email == email)
+        )
+    ).first()
+    # hand the connection back before the (slow) bcrypt check
+    await db.close()
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await verify_password(password, user.password):
         return False
     return user
 
 
-def add_new_user(db: Session, user_in: UserSignup):
-    existing = db.query(models.User).filter(models.User.email == user_in.email).first()
+async def add_new_user(db: AsyncSession, user_in: UserSignup):
+    existing = await db.scalar(select(models.User.id).where(models.User.email == user_in.email))
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
-    
-    hashed = pwd_context.hash(user_in.password)
+    # don't sit on a pooled connection while bcrypt runs
+    await db.close()
+
+    hashed = await password_pool.hash(user_in.password)
 
     new_user = models.User(
         email=user_in.email,
         name=user_in.name,
         password=hashed
     )
+    # db is a reader; the insert goes through the one writer connection
+    await asyncio.to_thread(_insert_user, new_user)
 
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-
-    print("user created !!")
+    event(log, "user_created", user_id=new_user.id)
 
     return {"id": new_user.id, "name": new_user.name, "email": new_user.email}
+
+
+def _insert_user(new_user):
+    with SessionLocal(expire_on_commit=False) as db:
+        db.add(new_user)
+        try:
+            db.commit()
+        except IntegrityError:
+            # someone signed up with the same email while we were hashing
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Email already registered")
@@ -0,0 +1,116 @@
+# wire.py
+# Wire formats: JSON (default) and MessagePack.
+#
+# REST: a request with `Accept: application/msgpack` gets a msgpack body;
+# anything else gets the usual JSON. NegotiatedRoute builds both handlers
+# once per route, so JSON responses keep FastAPI's fast serialization path.
+#
+# WebSocket: a client that offers the "msgpack" subprotocol gets binary
+# msgpack frames (and may send msgpack control frames); everyone else gets
+# JSON text frames. Broadcasts are encoded once per format in use, however
+# many sockets receive them (see ConnectionManager._deliver_local).
+#
+# msgpack is optional: without it the server simply never picks it.
+import json
+from datetime import datetime
+from typing import Any, List
+
+from fastapi import Request
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.routing import APIRoute
+from starlette.responses import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+WS_SUBPROTOCOLS = {"msgpack": MSGPACK, "json": JSON}
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+def encode(payload: Any, fmt: str = JSON):
+    """str for JSON, bytes for msgpack."""
+    if fmt == MSGPACK:
+        return msgpack.packb(payload, default=_default)
+    return json.dumps(payload, default=_default)
+
+
+def decode(data):
+    """A client frame: text is JSON, bytes are msgpack."""
+    if isinstance(data, bytes):
+        if msgpack is None:
+            raise ValueError("msgpack frames not supported")
+        return msgpack.unpackb(data)
+    return json.loads(data)
+
+
+# --------------------------------------------------
+# REST
+# --------------------------------------------------
+
+class MsgpackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=_default)
+
+
+def wants_msgpack(request: Request) -> bool:
+    if msgpack is None:
+        return False
+    accept = request.headers.get("accept", "")
+    return any(
+        part.split(";")[0].strip() == MSGPACK_MEDIA_TYPE for part in accept.split(",")
+    )
+
+
+class NegotiatedRoute(APIRoute):
+    """APIRoute that answers in msgpack when the client asks for it."""
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+        # routes that picked their own response class (streams etc.) stay as they are
+        if msgpack is None or not isinstance(self.response_class, DefaultPlaceholder):
+            return json_handler
+
+        default = self.response_class
+        self.response_class = MsgpackResponse
+        try:
+            msgpack_handler = super().get_route_handler()
+        finally:
+            self.response_class = default
+
+        async def handler(request: Request) -> Response:
+            if wants_msgpack(request):
+                response = await msgpack_handler(request)
+            else:
+                response = await json_handler(request)
+            response.headers.append("Vary", "Accept")
+            return response
+
+        return handler
+
+
+# --------------------------------------------------
+# WebSocket
+# --------------------------------------------------
+
+def pick_subprotocol(offered: List[str]):
+    """(subprotocol to echo or None, format) for the client's offer."""
+    for name in offered:
+        fmt = WS_SUBPROTOCOLS.get(name)
+        if fmt == MSGPACK and msgpack is None:
+            continue
+        if fmt:
+            return name, fmt
+    return None, JSON
@@ -0,0 +1,191 @@
+# write_pipeline.py
+# Opt-in group commit for chat messages.
+#
+# With CHAT_GROUP_COMMIT=1, post_message hands its message to MessageWriter
+# instead of committing on its own. The writer collects messages from many
+# requests into a batch (up to CHAT_GROUP_COMMIT_MAX_BATCH messages, or
+# CHAT_GROUP_COMMIT_MAX_DELAY_MS after the first one arrives), inserts the
+# whole batch in one transaction, and only then resolves each caller's
+# future. A caller therefore still gets its response (and its broadcast)
+# strictly after its message is committed; what changes is that one fsync
+# covers the whole batch.
+#
+# With sharded storage (shards.py) a batch is split by owning shard and each
+# part commits in its own transaction; a failure only fails that part.
+#
+# Batch counts and sizes are on /metrics as chat_group_commit_* gauges.
+import os
+import asyncio
+from datetime import datetime
+from typing import Callable, List, Optional
+
+import models
+import summaries
+from shards import router
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes", "on")
+
+
+class PendingMessage:
+    def __init__(self, convo_id: int, sender_id: int, content: str, future: asyncio.Future):
+        self.convo_id = convo_id
+        self.sender_id = sender_id
+        self.content = content
+        self.created_at = datetime.utcnow()
+        self.future = future
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_batch: int = 64,
+        max_delay: float = 0.005,
+        session_for: Optional[Callable] = None,
+    ):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # convo_id -> session factory of the database that owns it
+        self.session_for = session_for or (lambda convo_id: router.shard_for(convo_id).SessionLocal)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.messages = 0
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self._task:
+            return
+        # let everything already queued reach the database first
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, convo_id: int, sender_id: int, content: str) -> dict:
+        """Queue a message; resolves with its committed row once its batch commits."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(PendingMessage(convo_id, sender_id, content, future))
+        return await future
+
+    async def _collect(self) -> List[PendingMessage]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                rows = await asyncio.to_thread(self._write_batch, batch)
+            except Exception as exc:
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(exc)
+            else:
+                self.batches += 1
+                self.messages += len(batch)
+                for pending, row in zip(batch, rows):
+                    if pending.future.done():
+                        continue
+                    if isinstance(row, Exception):
+                        pending.future.set_exception(row)
+                    else:
+                        pending.future.set_result(row)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch: List[PendingMessage]) -> List:
+        """One row (or the exception that failed it) per message, in order."""
+        groups = {}
+        for i, pending in enumerate(batch):
+            groups.setdefault(self.session_for(pending.convo_id), []).append(i)
+        rows = [None] * len(batch)
+        for factory, indexes in groups.items():
+            try:
+                written = self._write_group(factory, [batch[i] for i in indexes])
+            except Exception as exc:
+                written = [exc] * len(indexes)
+            for i, row in zip(indexes, written):
+                rows[i] = row
+        return rows
+
+    def _write_group(self, session_factory, batch: List[PendingMessage]) -> List[dict]:
+        db = session_factory()
+        try:
+            msgs = [
+                models.Message(
+                    conversation_id=p.convo_id,
+                    sender_id=p.sender_id,
+                    content=p.content,
+                    created_at=p.created_at,
+                    status="sent",
+                )
+                for p in batch
+            ]
+            db.add_all(msgs)
+            db.flush()
+            summaries.apply_messages(db, msgs)
+
+            sender_ids = {m.sender_id for m in msgs}
+            names = dict(
+                db.query(models.User.id, models.User.name)
+                .filter(models.User.id.in_(sender_ids))
+                .all()
+            )
+            # read everything before commit() expires the instances
+            rows = [
+                {
+                    "id": m.id,
+                    "conversation_id": m.conversation_id,
+                    "sender_id": m.sender_id,
+                    "sender_name": names.get(m.sender_id),
+                    "content": m.content,
+                    "created_at": m.created_at,
+                    "status": m.status,
+                }
+                for m in msgs
+            ]
+            db.commit()
+            return rows
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": (self.messages / self.batches) if self.batches else 0,
+            "queued": self._queue.qsize() if self._queue else 0,
+        }
+
+
+message_writer = MessageWriter(
+    enabled=_env_flag("CHAT_GROUP_COMMIT"),
+    max_batch=int(os.getenv("CHAT_GROUP_COMMIT_MAX_BATCH", "64")),
+    max_delay=float(os.getenv("CHAT_GROUP_COMMIT_MAX_DELAY_MS", "5")) / 1000,
+)
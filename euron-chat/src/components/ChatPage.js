@@ -22,6 +22,8 @@ const mapConversationItem = (ci) => ({
   lastMessage: ci.last_message,
   lastMessageAt: ci.last_message_at,
   messages: [],
+  // X-Next-Cursor of the oldest loaded page; null when there is nothing older
+  olderCursor: null,
 });
 
 const mapMessageOutToUI = (msg, currentUserId) => ({
@@ -59,8 +61,10 @@ export default function ChatPage() {
   const [groupUsers, setGroupUsers] = useState([]);
 
   const [participants, setParticipants] = useState([]);
+  const [loadingOlder, setLoadingOlder] = useState(false);
 
   const messagesEndRef = useRef(null);
+  const skipScrollRef = useRef(false);
   const searchTimeoutRef = useRef(null);
   const wsRef = useRef(null);
 
@@ -72,6 +76,11 @@ export default function ChatPage() {
   --------------------------------------- */
 
   useEffect(() => {
+    // prepending older history shouldn't yank the view to the bottom
+    if (skipScrollRef.current) {
+      skipScrollRef.current = false;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [activeId, conversations]);
 
@@ -90,6 +99,7 @@ export default function ChatPage() {
         if (res.status === 401) return navigate("/login");
         if (!res.ok) throw new Error();
 
+        const olderCursor = res.headers.get("X-Next-Cursor");
         const msgs = await res.json();
         const mapped = msgs.map((m) =>
           mapMessageOutToUI(m, currentUserId)
@@ -97,7 +107,9 @@ export default function ChatPage() {
 
         setConversations((prev) =>
           prev.map((c) =>
-            c.id === conversationId ? { ...c, messages: mapped } : c
+            c.id === conversationId
+              ? { ...c, messages: mapped, olderCursor }
+              : c
           )
         );
       } catch {
@@ -107,6 +119,43 @@ export default function ChatPage() {
     [currentUserId, navigate]
   );
 
+  /* ---------------------------------------
+     LOAD OLDER MESSAGES (before= cursor)
+  --------------------------------------- */
+
+  const loadOlderMessages = async (conversation) => {
+    if (!conversation.olderCursor || loadingOlder) return;
+
+    setLoadingOlder(true);
+    try {
+      const res = await apiFetch(
+        `/conversations/${conversation.id}/messages?before=${encodeURIComponent(
+          conversation.olderCursor
+        )}`
+      );
+      if (res.status === 401) return navigate("/login");
+      if (!res.ok) throw new Error();
+
+      const olderCursor = res.headers.get("X-Next-Cursor");
+      const older = (await res.json()).map((m) =>
+        mapMessageOutToUI(m, currentUserId)
+      );
+
+      skipScrollRef.current = true;
+      setConversations((prev) =>
+        prev.map((c) =>
+          c.id === conversation.id
+            ? { ...c, messages: [...older, ...c.messages], olderCursor }
+            : c
+        )
+      );
+    } catch {
+      setError("Unable to load older messages.");
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
 
   /*----------------------------------------
     LIST GROUP PARTICIPANTS
@@ -137,10 +186,20 @@ export default function ChatPage() {
         const me = await apiFetch("/me");
         if (me.status === 401) return navigate("/login");
 
-        const convRes = await apiFetch("/conversations");
-        if (!convRes.ok) throw new Error();
-
-        const data = await convRes.json();
+        // /conversations comes in pages of 100; follow X-Next-Cursor
+        // until the whole list is in
+        let data = [];
+        let cursor = null;
+        do {
+          const convRes = await apiFetch(
+            cursor
+              ? `/conversations?cursor=${encodeURIComponent(cursor)}`
+              : "/conversations"
+          );
+          if (!convRes.ok) throw new Error();
+          data = data.concat(await convRes.json());
+          cursor = convRes.headers.get("X-Next-Cursor");
+        } while (cursor && mounted);
         if (!mounted) return;
 
         const mapped = data.map(mapConversationItem);
@@ -277,12 +336,11 @@ export default function ChatPage() {
       `${proto}://${window.location.hostname}:8000`;
 
     const ws = new WebSocket(
-      `${base}/ws/${activeId}?token=${encodeURIComponent(token)}`
+      `${base}/ws/${activeId}?token=${encodeURIComponent(token)}&batch=1`
     );
     wsRef.current = ws;
 
-    ws.onmessage = (e) => {
-      const payload = JSON.parse(e.data);
+    const handleEvent = (payload) => {
       if (payload.type !== "message_created") return;
 
       const m = payload.message;
@@ -303,6 +361,21 @@ export default function ChatPage() {
       );
     };
 
+    ws.onmessage = (e) => {
+      const payload = JSON.parse(e.data);
+      if (payload.type === "ping") {
+        // heartbeat: answering keeps the server from treating us as gone
+        ws.send(JSON.stringify({ type: "pong" }));
+        return;
+      }
+      // busy large groups send several events in one frame
+      if (payload.type === "batch") {
+        payload.events.forEach(handleEvent);
+        return;
+      }
+      handleEvent(payload);
+    };
+
     return () => ws.close();
   }, [activeId, currentUserId]);
 
@@ -481,6 +554,15 @@ export default function ChatPage() {
 
 
             <section className="chat-messages">
+              {activeConversation.olderCursor && (
+                <button
+                  className="load-older"
+                  onClick={() => loadOlderMessages(activeConversation)}
+                  disabled={loadingOlder}
+                >
+                  {loadingOlder ? "Loading…" : "Load older messages"}
+                </button>
+              )}
               {activeConversation.messages.map((m) => (
                 <div
                   key={m.id}